@@ -0,0 +1,59 @@
+# Camera capture profile for TAMV: ask the driver for a pixel format, resolution and
+# frame rate, keep its buffer to one frame so we always see the newest image, and lock
+# exposure and focus so the nozzle does not change brightness or sharpness between moves.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Every setting is a request; drivers are free to ignore them.  openCamera() prints what
+# the driver actually gave us.
+#
+
+import time
+import cv2
+
+def openCamera(index, width=0, height=0, fps=0, fourcc=None, exposure=None, focus=None):
+    vs = cv2.VideoCapture(index)
+    if (fourcc):                                   # MJPG for high frame rates over USB 2, YUYV to avoid JPEG artifacts.
+        vs.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    if (width and height):
+        vs.set(cv2.CAP_PROP_FRAME_WIDTH,  width)
+        vs.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    if (fps): vs.set(cv2.CAP_PROP_FPS, fps)
+    vs.set(cv2.CAP_PROP_BUFFERSIZE, 1)             # Newest frame only.  Stale frames make moves look like they have not happened.
+    if (exposure is not None):
+        vs.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)      # V4L2: 1 is manual, 3 is auto.
+        vs.set(cv2.CAP_PROP_EXPOSURE, exposure)
+    if (focus is not None):
+        vs.set(cv2.CAP_PROP_AUTOFOCUS, 0)
+        vs.set(cv2.CAP_PROP_FOCUS, focus)
+
+    f = int(vs.get(cv2.CAP_PROP_FOURCC))
+    print("Camera {0:d}: {1:d}x{2:d} {3:s} at {4:1.0f} FPS, buffer {5:1.0f}".format(index,
+        int(vs.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vs.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        ''.join([chr((f >> 8*i) & 0xFF) for i in range(4)]), vs.get(cv2.CAP_PROP_FPS), vs.get(cv2.CAP_PROP_BUFFERSIZE)))
+    return(vs)
+
+def detect(detector, frame, scale=1.0, gray=False):
+    # Run the detector on a smaller and/or single channel copy of the frame, and
+    # map the keypoints back to full resolution so callers never know the difference.
+    im = frame
+    if (gray and len(im.shape) == 3): im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    if (scale == 1.0): return(detector.detect(im))
+    im = cv2.resize(im, (0,0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Pixel centers line up as (x+0.5)/scale-0.5, not x/scale; the latter is half a (small) pixel off.
+    return([cv2.KeyPoint((k.pt[0]+0.5)/scale-0.5, (k.pt[1]+0.5)/scale-0.5, k.size/scale) for k in detector.detect(im)])
+
+def measureLatency(vs, detector, frames=30, scale=1.0, gray=False):
+    # Time from asking for a frame to having its keypoints, over a few frames at startup.
+    grab, det = 0.0, 0.0
+    for i in range(frames):
+        t0 = time.time()
+        (grabbed, frame) = vs.read()
+        t1 = time.time()
+        if (grabbed): detect(detector, frame, scale, gray)
+        t2 = time.time()
+        grab += t1 - t0
+        det  += t2 - t1
+    print("Capture to detection latency {0:1.1f} ms (capture {1:1.1f} ms, detection {2:1.1f} ms), {3:1.1f} FPS".format(
+        1000*(grab+det)/frames, 1000*grab/frames, 1000*det/frames, frames/(grab+det)))
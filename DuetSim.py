@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# DuetSim = a simulated Duet, for measuring and testing TAMV and ZTATP without a printer.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Serves the HTTP endpoints DuetWebAPI uses (RRF2 rr_* or RRF3 /machine/*), backed by a simple
+# machine model: positions, tool offsets, tool changes, a touch plate, and move times.
+# Every request can be given latency, jitter and injected failures.
+#
+# Run on its own, it just serves; point TAMV or ZTATP at it with -duet localhost:PORT.
+# With -benchmark, it also runs the TAMV and/or ZTATP flows against itself, TAMV seeing a
+# rendered nozzle instead of a camera, and reports the time spent in each DuetWebAPI call.
+#
+
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+configG = '''; Simulated config.g
+M574 X1 S1 P"xstop"
+M574 Y1 S1 P"ystop"
+M574 Z1 S2
+M558 P8 C"zprobe.in" H3 F360 T6000
+'''
+
+###################################################################################
+# Machine model
+###################################################################################
+class SimMachine:
+    def __init__(self, tools=4, motion=1.0, toolChange=4.0, camera=(150.0,300.0), plate=(100.0,100.0,0.0)):
+        self.lock = threading.RLock()
+        self.axes = 'XYZ'
+        self.pos = [0.0, 0.0, 10.0]     # Machine (carriage) position. User position is this plus the tool's G10 offset.
+        self.relative = False
+        self.feed = 6000.0              # mm/min
+        self.tool = -1
+        self.motion = motion            # Scale on simulated move and tool change times; 0 is instant.
+        self.toolChange = toolChange    # Seconds per tool change.
+        self.segments = []              # Queued moves: (start time, end time, from, to)
+        self.camera = camera            # Machine XY at which a nozzle (or T-1's controlled point) is centered on camera.
+        self.plate = plate              # Touch plate X, Y, top Z
+        self.probeLen = 1.5             # How far the Z probe triggers below the carriage.
+        rng = random.Random(1)
+        # Offsets as configured (roughly right, as TAMV requires), and as really built.
+        self.offsets = [[rng.uniform(-30,30), rng.uniform(-5,5), -rng.uniform(1,3)] for t in range(tools)]
+        self.true    = [[o[0]+rng.uniform(-0.3,0.3), o[1]+rng.uniform(-0.3,0.3), o[2]+rng.uniform(-0.2,0.2)] for o in self.offsets]
+        self.toolLen = [self.probeLen + rng.uniform(-0.5,0.5) for t in range(tools)]
+
+    def offset(self):
+        return(self.offsets[self.tool] if self.tool >= 0 else [0.0,0.0,0.0])
+
+    def userPos(self):
+        with self.lock:
+            return([self.pos[i] + self.offset()[i] for i in range(3)])
+
+    def busyUntil(self):
+        return(self.segments[-1][1] if self.segments else 0.0)
+
+    def wait(self):
+        # M400 and friends: block until all queued motion is done.
+        t = self.busyUntil() - time.time()
+        if (t > 0): time.sleep(t)
+
+    def queueMove(self, to, seconds):
+        now = time.time()
+        start = max(now, self.busyUntil())
+        self.segments = [s for s in self.segments if s[1] > now]
+        self.segments.append((start, start + seconds*self.motion, list(self.pos), list(to)))
+        self.pos = list(to)
+
+    def posAt(self, t):
+        # Carriage position at time t, interpolated along queued moves; for the simulated camera.
+        with self.lock:
+            for (s, e, a, b) in self.segments:
+                if (t < s): return(a)
+                if (t < e): return([a[i] + (b[i]-a[i])*(t-s)/(e-s) for i in range(3)])
+            return(list(self.pos))
+
+    def nozzleAt(self, t):
+        # Physical XY of whatever is mounted: a nozzle, or the controlled point for T-1.
+        p = self.posAt(t)
+        with self.lock:
+            o = self.true[self.tool] if self.tool >= 0 else [0.0,0.0,0.0]
+            return([p[0]+o[0], p[1]+o[1]])
+
+    def gCode(self, line):
+        # Execute one line, which may hold several commands (TAMV sends "G91 G1 X-0.5 G90").
+        # T only starts a command at the beginning of a line; after a G or M it is a parameter (M558 ... T6000).
+        cmds = []
+        for w in line.split():
+            if (w[0].upper() in 'GM' or not cmds): cmds.append([w.upper()])
+            else: cmds[-1].append(w)
+        with self.lock:
+            self.mustWait = False
+            for c in cmds: self.command(c[0], {w[0].upper():w[1:] for w in c[1:]})
+            mustWait = self.mustWait
+        if (mustWait): self.wait()          # Outside the lock, so the camera keeps seeing the motion.
+        return('')
+
+    def command(self, cmd, p):
+        def num(k, d=None):
+            try:
+                return(float(p[k]))
+            except (KeyError, ValueError):
+                return(d)
+        if (cmd == 'G90'): self.relative = False
+        elif (cmd == 'G91'): self.relative = True
+        elif (cmd in ['G0','G1']):
+            if (num('F')): self.feed = num('F')
+            off = self.offset()
+            to = list(self.pos)
+            for i in range(3):
+                v = num(self.axes[i])
+                if (v is None): continue
+                to[i] = self.pos[i] + v if self.relative else v - off[i]
+            d = sum([(to[i]-self.pos[i])**2 for i in range(3)]) ** 0.5
+            self.queueMove(to, d / (self.feed/60))
+        elif (cmd == 'G10' and num('P') is not None and 0 <= int(num('P')) < len(self.offsets)):
+            t = int(num('P'))
+            for i in range(3):
+                if (num(self.axes[i]) is not None): self.offsets[t][i] = num(self.axes[i])
+        elif (cmd[0] == 'T'):
+            try:
+                t = int(cmd[1:])
+            except ValueError:
+                return
+            if (t < -1 or t >= len(self.offsets)): return      # RRF ignores tools that do not exist.
+            if (t != self.tool):
+                self.queueMove(self.pos, self.toolChange)
+                self.tool = t
+        elif (cmd == 'G30'):
+            if (num('X') is not None): self.queueMove([num('X') - self.offset()[0], num('Y') - self.offset()[1], self.pos[2]], 1.0)
+            length = self.probeLen if (self.tool < 0 or num('S') is None) else self.toolLen[self.tool]
+            self.queueMove([self.pos[0], self.pos[1], self.plate[2] + length], 2.0)   # Probe down until it touches.
+            self.mustWait = True
+        elif (cmd in ['M400','G28']): self.mustWait = True
+        # Everything else (M558, M574, M500, ...) is accepted and ignored.
+
+###################################################################################
+# HTTP front end
+###################################################################################
+class SimServer(ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, port, machine, version=3, latency=0.0, jitter=0.0, faults=0.0, faultMode='error', hang=30.0):
+        super().__init__(('127.0.0.1', port), SimHandler)
+        self.machine = machine
+        self.version = version
+        self.latency = latency      # Seconds
+        self.jitter = jitter        # Seconds, uniform +/-
+        self.faults = faults        # Probability that a request fails
+        self.faultMode = faultMode  # error (HTTP 500), drop (close connection), or hang (respond after hang seconds)
+        self.hang = hang
+        self.rng = random.Random(2)
+        self.stats = {}             # Endpoint: [count, seconds]
+        self.statsLock = threading.Lock()
+
+class SimHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass    # Quiet; stats are reported instead.
+
+    def do_GET(self):
+        self.handle_request(None)
+
+    def do_POST(self):
+        n = int(self.headers.get('Content-Length', 0))
+        self.handle_request(self.rfile.read(n).decode())
+
+    def handle_request(self, body):
+        srv = self.server
+        t0 = time.time()
+        url = urllib.parse.urlparse(self.path)
+        endpoint = url.path.rstrip('/')
+        q = urllib.parse.parse_qs(url.query)
+        delay = srv.latency + srv.rng.uniform(-srv.jitter, srv.jitter)
+        if (delay > 0): time.sleep(delay)
+        if (srv.faults and srv.rng.random() < srv.faults):
+            with srv.statsLock:
+                s = srv.stats.setdefault('faults injected', [0, 0.0])
+                s[0] += 1
+            if (srv.faultMode == 'drop'):
+                self.close_connection = True
+                return
+            if (srv.faultMode == 'hang'): time.sleep(srv.hang)
+            else: return(self.reply(500, 'Injected fault'))
+
+        m = srv.machine
+        if (srv.version == 2 and endpoint == '/rr_status'):
+            self.reply(200, json.dumps({'status':'I', 'coords':{'xyz':m.userPos()}, 'axisNames':m.axes,
+                'currentTool':m.tool, 'tools':[{'number':i, 'offsets':m.offsets[i]} for i in range(len(m.offsets))]}))
+        elif (srv.version == 2 and endpoint == '/rr_gcode'):
+            self.reply(200, json.dumps({'buff':255, 'reply':m.gCode(q.get('gcode',[''])[0])}))
+        elif (srv.version == 2 and endpoint == '/rr_download'):
+            self.reply(200, configG)
+        elif (srv.version == 3 and endpoint == '/machine/status'):
+            u = m.userPos()
+            self.reply(200, json.dumps({'result':{'state':{'status':'idle', 'currentTool':m.tool},
+                'move':{'axes':[{'letter':m.axes[i], 'userPosition':u[i], 'machinePosition':m.pos[i]} for i in range(3)]},
+                'tools':[{'number':i, 'offsets':m.offsets[i]} for i in range(len(m.offsets))]}}))
+        elif (srv.version == 3 and endpoint == '/machine/code'):
+            self.reply(200, m.gCode(body or ''))
+        elif (srv.version == 3 and endpoint == '/machine/file/sys/config.g'):
+            self.reply(200, configG)
+        else:
+            self.reply(404, 'Not found')
+        with srv.statsLock:
+            s = srv.stats.setdefault(endpoint, [0, 0.0])
+            s[0] += 1
+            s[1] += time.time() - t0
+
+    def reply(self, code, text):
+        data = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json' if text[:1] in '{[' else 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+###################################################################################
+# Simulated camera, so TAMV can run its real vision code against the machine model
+###################################################################################
+class SimCamera:
+    def __init__(self, machine, width=640, height=480, mpp=0.01, radius=20, noise=4.0, fps=30):
+        import numpy as np
+        self.np = np
+        self.m = machine
+        self.w, self.h, self.mpp, self.r, self.noise, self.fps = width, height, mpp, radius, noise, fps
+        self.yy, self.xx = np.mgrid[0:height, 0:width]
+        self.last = 0.0
+
+    def read(self):
+        np = self.np
+        t = self.last + 1.0/self.fps - time.time()
+        if (t > 0): time.sleep(t)
+        self.last = time.time()
+        n = self.m.nozzleAt(self.last)
+        cx = self.w/2 + (n[0] - self.m.camera[0]) / self.mpp
+        cy = self.h/2 - (n[1] - self.m.camera[1]) / self.mpp    # Image Y runs down.
+        im = np.full((self.h, self.w), 230.0)
+        im[(self.xx-cx)**2 + (self.yy-cy)**2 < self.r**2] = 40.0
+        im += np.random.normal(0, self.noise, im.shape)
+        im = np.clip(im, 0, 255).astype(np.uint8)
+        return(True, np.dstack([im,im,im]))
+
+    def set(self, prop, value):
+        return(False)
+
+    def get(self, prop):
+        import cv2
+        return({cv2.CAP_PROP_FRAME_WIDTH:self.w, cv2.CAP_PROP_FRAME_HEIGHT:self.h, cv2.CAP_PROP_FPS:self.fps}.get(prop, 0))
+
+###################################################################################
+# Benchmark
+###################################################################################
+class TimedPrinter:
+    # Wraps a DuetWebAPI connection and times every call made through it.  Calls that fail
+    # (injected faults show up as HTTP errors, bad JSON or dropped connections) are counted
+    # and retried, so a faulty run still finishes and reports how much the faults cost.
+    def __init__(self, printer, retries=5):
+        self.printer = printer
+        self.retries = retries
+        self.stats = {}     # Method: list of seconds, including any failed attempts
+        self.failed = {}    # Method: number of failed attempts
+
+    def __getattr__(self, name):
+        f = getattr(self.printer, name)
+        if (not callable(f)): return(f)
+        def timed(*args, **kwargs):
+            t0 = time.time()
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        return(f(*args, **kwargs))
+                    except Exception:
+                        self.failed[name] = self.failed.get(name, 0) + 1
+                        if (attempt == self.retries): raise
+            finally:
+                self.stats.setdefault(name, []).append(time.time() - t0)
+        return(timed)
+
+def report(title, seconds, printer, server):
+    print()
+    print(title+' took {0:1.2f} s'.format(seconds))
+    print('+------------------------------------------------------------------------+')
+    print('| DuetWebAPI call    | Calls | Failed |  Total s |  Mean ms |   Max ms |')
+    total = 0.0
+    for name, s in sorted(printer.stats.items(), key=lambda i: -sum(i[1])):
+        total += sum(s)
+        print('| {0:18s} | {1:5d} | {2:6d} | {3:8.2f} | {4:8.1f} | {5:8.1f} |'.format(name, len(s), printer.failed.get(name, 0),
+            sum(s), 1000*sum(s)/len(s), 1000*max(s)))
+    print('+------------------------------------------------------------------------+')
+    print('{0:1.0f}% of the run was spent waiting on the printer.'.format(100*total/seconds if seconds else 0))
+    print('Server side, per endpoint: '+', '.join(['{0:s} {1:d} calls {2:1.2f} s'.format(k, v[0], v[1]) for k, v in sorted(server.stats.items())]))
+
+def benchZTATP(port, server):
+    import DuetWebAPI as DWA
+    import ZTATP
+    m = server.machine
+    ZTATP.prt = TimedPrinter(DWA.DuetWebAPI('http://127.0.0.1:{0:d}'.format(port)))
+    ZTATP.tp  = [m.plate[0], m.plate[1]]
+    ZTATP.pin = '!io5.in'
+    t0 = time.time()
+    ZTATP.probePlate()
+    for t in range(ZTATP.prt.getNumTools()):
+        ZTATP.probeTool(t)
+    ZTATP.prt.resetEndstops()
+    report('ZTATP', time.time()-t0, ZTATP.prt, server)
+
+def benchTAMV(port, server, tmp):
+    import TAMV
+    m = server.machine
+    args = TAMV.parseArgs(['-duet','127.0.0.1:{0:d}'.format(port), '-cp', str(m.camera[0]), str(m.camera[1]),
+        '-nodaemon', '-results', os.path.join(tmp,'results.jsonl')])
+    TAMV.setDeviceOptions(args)
+    TAMV.setOptions(args)
+    TAMV.lastRunFile = os.path.join(tmp,'last.json')
+    TAMV.loadLibraries()
+    TAMV.Camera.openCamera = lambda *a, **k: SimCamera(m)
+    TAMV.cv2.imshow = lambda *a: None       # No window; the benchmark may be running over SSH.
+    TAMV.cv2.waitKey = lambda *a: -1
+    os.environ.pop('SSH_CLIENT', None)
+    TAMV.startVideo()
+    TAMV.connectPrinter()
+    TAMV.printer = TimedPrinter(TAMV.printer)
+    t0 = time.time()
+    try:
+        TAMV.alignTools()
+    finally:
+        TAMV.txq.put([TAMV.FOAD])
+    report('TAMV', time.time()-t0, TAMV.printer, server)
+    print('True XY offsets were: '+', '.join(['T{0:d} X{1:1.3f} Y{2:1.3f}'.format(t, o[0], o[1]) for t, o in enumerate(m.true)]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Duet printer for load, latency and fault testing of TAMV and ZTATP.', allow_abbrev=False)
+    parser.add_argument('-port',type=int,nargs=1,default=[8080],help='Port to listen on. Default 8080.')
+    parser.add_argument('-version',type=int,nargs=1,default=[3],choices=[2,3],help='Duet/RepRap firmware API to imitate. Default 3.')
+    parser.add_argument('-tools',type=int,nargs=1,default=[4],help='Number of tools. Default 4.')
+    parser.add_argument('-latency',type=float,nargs=1,default=[0.0],help='Added to every request, in ms.')
+    parser.add_argument('-jitter',type=float,nargs=1,default=[0.0],help='Random +/- added to latency, in ms.')
+    parser.add_argument('-motion',type=float,nargs=1,default=[1.0],help='Scale on simulated move and tool change times. 0 makes motion instant. Default 1.')
+    parser.add_argument('-toolchange',type=float,nargs=1,default=[4.0],help='Seconds per simulated tool change. Default 4.')
+    parser.add_argument('-faults',type=float,nargs=1,default=[0.0],help='Probability, 0 to 1, that any request fails.')
+    parser.add_argument('-faultmode',type=str,nargs=1,default=['error'],choices=['error','drop','hang'],help='How injected failures fail: HTTP 500, dropped connection, or a long hang. Default error.')
+    parser.add_argument('-benchmark',type=str,nargs=1,default=[None],choices=['tamv','ztatp','both'],help='Run TAMV and/or ZTATP against the simulator and report time per DuetWebAPI call, then exit.')
+    args=vars(parser.parse_args())
+
+    port = args['port'][0]
+    machine = SimMachine(tools=args['tools'][0], motion=args['motion'][0], toolChange=args['toolchange'][0])
+    server = SimServer(port, machine, version=args['version'][0], latency=args['latency'][0]/1000, jitter=args['jitter'][0]/1000,
+        faults=args['faults'][0], faultMode=args['faultmode'][0])
+    print('Simulated Duet V{0:d} with {1:d} tools listening on 127.0.0.1:{2:d}'.format(args['version'][0], args['tools'][0], port))
+    print('Camera (controlled point) at X{0:1.3f} Y{1:1.3f}, touch plate at X{2:1.3f} Y{3:1.3f}'.format(
+        machine.camera[0], machine.camera[1], machine.plate[0], machine.plate[1]))
+
+    if (args['benchmark'][0] is None):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        if (args['benchmark'][0] in ['ztatp','both']): benchZTATP(port, server)
+        if (args['benchmark'][0] in ['tamv','both']):
+            server.stats = {}
+            benchTAMV(port, server, tmp)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Records camera frames from TAMV, with what the circle detector made of them,
+# so that failed runs can be looked at (and replayed) afterwards.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Frames are written as PNG (lossless) by a writer thread, fed through a bounded queue.
+# If the disk cannot keep up, frames are dropped and counted; the video thread never waits.
+# Unless told to keep everything, only a rolling window of recent frames is held in memory,
+# and it is written out when detection fails, along with the frames that follow.  Only frames
+# TAMV is actually waiting on count as failures; during tool changes and travel there is
+# often no circle to see.
+#
+
+import os
+import json
+import time
+import queue
+import threading
+import collections
+import cv2
+
+class FrameRecorder:
+    def __init__(self, path, keepAll=False, before=30, after=30, queueSize=64):
+        self.path    = os.path.join(path, time.strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(self.path, exist_ok=True)
+        self.keepAll = keepAll
+        self.after   = after
+        self.window  = collections.deque(maxlen=before)  # Recent frames, not yet written.
+        self.q       = queue.Queue(maxsize=queueSize)
+        self.frameNo = 0
+        self.pending = 0        # Frames still to write after the last failure.
+        self.dropped = 0
+        self.written = 0
+        self.thread  = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def add(self, frame, rot, keypoints, moveSeq, watching=True):
+        # Called from the video thread for every frame the detector looked at.  watching is
+        # whether the alignment loop wants detections from this frame.
+        lk = len(keypoints)
+        entry = {'frame':self.frameNo, 'time':time.time(), 'move':moveSeq, 'rot':rot, 'watching':watching,
+            'status':'ok' if lk == 1 else ('none' if lk == 0 else 'many'),
+            'keypoints':[[k.pt[0], k.pt[1], k.size] for k in keypoints]}
+        self.frameNo += 1
+        if (self.keepAll):
+            self.persist(entry, frame)
+        elif (watching and entry['status'] != 'ok'):
+            while (self.window): self.persist(*self.window.popleft())
+            self.persist(entry, frame)
+            self.pending = self.after
+        elif (self.pending > 0):
+            self.persist(entry, frame)
+            self.pending -= 1
+        else:
+            self.window.append((entry, frame))
+
+    def persist(self, entry, frame):
+        try:
+            self.q.put_nowait((entry, frame))
+        except queue.Full:
+            self.dropped += 1
+
+    def writer(self):
+        with open(os.path.join(self.path, 'frames.jsonl'),'a') as index:
+            while True:
+                item = self.q.get()
+                if (item is None): return
+                entry, frame = item
+                entry['file'] = '{0:06d}.png'.format(entry['frame'])
+                cv2.imwrite(os.path.join(self.path, entry['file']), frame)
+                index.write(json.dumps(entry)+'\n')
+                index.flush()
+                self.written += 1
+
+    def close(self):
+        self.q.put(None)    # Let the writer finish what is queued, then stop.
+        self.thread.join()
+        print("Frame recorder wrote {0:d} frames to {1:s}, dropped {2:d}.".format(self.written, self.path, self.dropped))
+
+def loadRecording(path):
+    # Replay a recording: yields (entry, frame) in the order the frames were captured.
+    with open(os.path.join(path, 'frames.jsonl')) as index:
+        for line in index:
+            entry = json.loads(line)
+            yield (entry, cv2.imread(os.path.join(path, entry['file'])))
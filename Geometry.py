@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Geometry helpers for TAMV and friends, working on whole NumPy arrays of points at once.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Points and moves are (N,2) arrays, or a single (2,) point; results keep the same leading shape.
+# Nothing is rounded here.  Round when printing, not when calculating; MPP in particular was
+# losing a lot to the old int() pixel distances.
+#
+# Run this file directly for a microbenchmark against the old scalar helpers.
+#
+
+import numpy as np
+
+def dist(a, b):
+    # Euclidean distance between corresponding points of a and b.
+    d = np.asarray(b, dtype=float) - np.asarray(a, dtype=float)
+    return(np.hypot(d[...,0], d[...,1]))
+
+def norm(v):
+    v = np.asarray(v, dtype=float)
+    return(np.hypot(v[...,0], v[...,1]))
+
+def pixelsToMM(pixels, target, mpp, drctn):
+    # Carriage move (mm) that takes points at pixels to target, for the simple MPP and direction
+    # calibration eachTool() finds.
+    return((np.asarray(target, dtype=float) - np.asarray(pixels, dtype=float)) * mpp * np.asarray(drctn))
+
+def stats(values, axis=0):
+    # Average, max, min and standard deviation along one axis, e.g. across repeats for every tool and axis at once.
+    values = np.asarray(values, dtype=float)
+    return({'avg':np.average(values, axis=axis), 'max':np.max(values, axis=axis),
+            'min':np.min(values, axis=axis), 'std':np.std(values, axis=axis)})
+
+###################################################################################
+# Microbenchmark
+###################################################################################
+def bench(n=100000):
+    import timeit
+
+    def vectDist(xy1,xy2):  # As it was in TAMV.py
+        return int(np.around(np.sqrt(abs( \
+            (float(xy2[0]) - float(xy1[0])) ** float(2) + \
+            (float(xy2[1]) - float(xy1[1])) ** float(2)   \
+            ))))
+
+    rng = np.random.default_rng(0)
+    a = rng.uniform(0, 640, (n,2))
+    b = rng.uniform(0, 640, (n,2))
+    vals = rng.normal(0, 1, (10, 5, 3))
+
+    def scalarStats():      # As repeatReport() did it, one tool and one column at a time.
+        return([[(np.average([vals[i][t][c] for i in range(10)]), np.max([vals[i][t][c] for i in range(10)]),
+                  np.min([vals[i][t][c] for i in range(10)]),     np.std([vals[i][t][c] for i in range(10)]))
+                 for c in range(3)] for t in range(5)])
+
+    tScalar = timeit.timeit(lambda: [vectDist(a[i],b[i]) for i in range(n)], number=1)
+    tBatch  = timeit.timeit(lambda: dist(a,b), number=1)
+    print("Distance, {0:d} points: scalar vectDist {1:8.2f} ms, dist() {2:8.2f} ms, {3:6.0f}x".format(n, tScalar*1000, tBatch*1000, tScalar/tBatch))
+    err = np.abs(np.array([vectDist(a[i],b[i]) for i in range(1000)]) - dist(a[:1000],b[:1000]))
+    print("    Worst error from int() rounding in vectDist: {0:1.3f} pixels".format(err.max()))
+    tScalar = timeit.timeit(scalarStats, number=10) / 10
+    tBatch  = timeit.timeit(lambda: stats(vals), number=10) / 10
+    print("Repeat statistics, 10 repeats x 5 tools x 3 columns: scalar {0:8.3f} ms, stats() {1:8.3f} ms, {2:6.0f}x".format(tScalar*1000, tBatch*1000, tScalar/tBatch))
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,74 @@
+# Pixel to millimeter model for TAMV's camera, covering lens distortion, scale and rotation.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# A single MPP taken from one 0.5mm jog is only right near the middle of the frame, which is why
+# the alignment loop has to creep up on the center.  Here the carriage is jogged over a small grid,
+# the nozzle is found at each point, and a cubic polynomial in pixel X,Y is fitted to the carriage
+# offsets.  Given where a nozzle is seen, the model then says how far to move to put it anywhere
+# else in the frame, in one move.
+#
+# Models depend on camera, resolution and image rotation, and are cached per combination.  A
+# model is only valid at the rotation it was fitted at; callers must restore model['rot'] first.
+#
+
+import os
+import json
+import numpy as np
+
+lensFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),'TAMV_lens.json')
+
+def lensKey(camera, target, rot):
+    # target is the frame center, as the video thread reports it.
+    return('camera{0:d} {1:d}x{2:d} rot{3:d}'.format(camera, int(target[0])*2, int(target[1])*2, rot))
+
+def gridOffsets(span, steps=5):
+    # Carriage offsets, in mm, from -span to +span in X and Y.
+    g = np.linspace(-span, span, steps)
+    gx, gy = np.meshgrid(g, g)
+    return(np.column_stack([gx.ravel(), gy.ravel()]))
+
+def terms(model, pixels):
+    # Cubic polynomial terms in normalized pixel coordinates, one row per point.
+    p = (np.atleast_2d(np.array(pixels, dtype=float)) - model['center']) / model['scale']
+    u, v = p[:,0], p[:,1]
+    return(np.column_stack([np.ones_like(u), u, v, u*u, u*v, v*v, u**3, u*u*v, u*v*v, v**3]))
+
+def fit(pixels, moves, target, rot):
+    # pixels[i] is where the nozzle was seen with the carriage at offset moves[i], image rotated by rot.
+    pixels = np.array(pixels, dtype=float)
+    moves  = np.array(moves,  dtype=float)
+    model = {'center':np.array(target, dtype=float), 'scale':float(max(target)), 'rot':rot}
+    a = terms(model, pixels)
+    coef, res, rank, sv = np.linalg.lstsq(a, moves, rcond=None)
+    model['coef'] = coef
+    model['rms']  = float(np.sqrt(np.mean(np.sum((a @ coef - moves)**2, axis=1))))
+    return(model)
+
+def apply(model, pixels):
+    # Carriage offsets (mm) that correspond to nozzle positions (pixels).  Differences between
+    # two of these are the move that takes the nozzle from one pixel position to the other.
+    return(terms(model, pixels) @ model['coef'])
+
+def mmPerPixel(model):
+    # Scale at the frame center, from the linear terms.
+    j = model['coef'][1:3,:] / model['scale']
+    return(float(np.sqrt(abs(np.linalg.det(j)))))
+
+def load(key, path=lensFile):
+    if (not os.path.exists(path)): return(None)
+    with open(path) as f:
+        m = json.load(f).get(key)
+    if (m is None): return(None)
+    return({'center':np.array(m['center']), 'scale':m['scale'], 'coef':np.array(m['coef']), 'rms':m['rms'],
+            'rot':m.get('rot', int(key.rsplit('rot',1)[1]))})   # Older files only had it in the key. 
+
+def save(key, model, path=lensFile):
+    models = {}
+    if (os.path.exists(path)):
+        with open(path) as f:
+            models = json.load(f)
+    models[key] = {'center':model['center'].tolist(), 'scale':model['scale'], 'coef':model['coef'].tolist(), 'rms':model['rms'], 'rot':model['rot']}
+    with open(path,'w') as f:
+        json.dump(models, f, indent=2)
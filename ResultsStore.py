@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Append-only store of results from TAMV, ZTATP and repeatability runs,
+# plus a query tool to look at trends and drift across many runs.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Each run is one JSON object on one line of the store (JSON Lines), so appending never
+# rewrites earlier runs, and a partially written last line only loses that one run.
+#
+# Run this file directly to query the store; -h for help.
+#
+
+import os
+import json
+import time
+import socket
+import argparse
+import numpy as np
+
+storeFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),'TAMV_results.jsonl')
+
+###################################################################################
+# Writing
+###################################################################################
+def newRun(program, settings={}):
+    # Skeleton of a run record.  Callers fill in 'tools', 'stats' and 'timings'.
+    return({
+        'run':      time.strftime('%Y%m%d-%H%M%S')+'-'+str(os.getpid()),
+        'program':  program,
+        'time':     time.time(),
+        'host':     socket.gethostname(),
+        'settings': dict(settings),
+        'tools':    [],     # One dict per tool per pass: {'tool':n, 'pass':n, 'X':.., ...}
+        'stats':    {},
+        'timings':  {},
+        })
+
+def appendRun(record, path=storeFile):
+    line = json.dumps(record, default=jsonable)
+    with open(path,'a') as f:
+        f.write(line+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def jsonable(o):
+    # numpy scalars and arrays show up all over the place (np.around, np.uint16 pixels).
+    if hasattr(o,'tolist'): return(o.tolist())
+    return(str(o))
+
+###################################################################################
+# Reading
+###################################################################################
+def loadRuns(program=None, path=storeFile):
+    runs = []
+    if (not os.path.exists(path)): return(runs)
+    with open(path) as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue    # Interrupted write.  Skip it, keep the rest.
+            if (program is None or r['program'] == program): runs.append(r)
+    return(runs)
+
+def toolArray(runs, field):
+    # Returns (times, values) where values is runs x tools, averaged over passes within a run.
+    # Tools missing a field (or missing from a run) are NaN.
+    times = np.array([r['time'] for r in runs], dtype=float)
+    ri, ti, v = [], [], []
+    for i in range(len(runs)):
+        for e in runs[i]['tools']:
+            if (e.get(field) is None): continue
+            ri.append(i)
+            ti.append(e['tool'])
+            v.append(e[field])
+    ri = np.array(ri, dtype=int)
+    ti = np.array(ti, dtype=int)
+    v  = np.array(v,  dtype=float)
+    ntools = ti.max()+1 if len(ti) else 0
+    sums   = np.zeros((len(runs),ntools))
+    counts = np.zeros((len(runs),ntools))
+    np.add.at(sums,   (ri,ti), v)
+    np.add.at(counts, (ri,ti), 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = sums / counts
+    return(times, values)
+
+def trend(times, values):
+    # Per tool statistics across runs, all tools at once. NaN (missing) entries are ignored.
+    m = ~np.isnan(values)
+    n = m.sum(axis=0)
+    y = np.where(m, values, 0.0)
+    t = np.where(m, (times - times.min())[:,None] / 86400.0, 0.0)    # Days since first run
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tm   = t.sum(axis=0) / n
+        ym   = y.sum(axis=0) / n
+        dt   = np.where(m, t - tm, 0.0)
+        dy   = np.where(m, y - ym, 0.0)
+        std  = np.sqrt((dy**2).sum(axis=0) / n)
+        slope = (dt*dy).sum(axis=0) / (dt**2).sum(axis=0)  # Least squares drift per day
+    k = np.where(m, np.arange(len(times))[:,None], 0).max(axis=0)   # Latest run that has each tool
+    last = np.where(n > 0, values[k, np.arange(values.shape[1])], np.nan)
+    return({
+        'runs':  n,
+        'mean':  ym,
+        'std':   std,
+        'min':   np.where(m, values,  np.inf).min(axis=0),
+        'max':   np.where(m, values, -np.inf).max(axis=0),
+        'last':  last,
+        'drift': slope,
+        })
+
+def writeCSV(runs, path):
+    # Flat one-row-per-tool-per-pass export, for spreadsheets and other tools.
+    keys = []
+    for r in runs:
+        for e in r['tools']:
+            for k in e:
+                if (k not in keys): keys.append(k)
+    with open(path,'w') as f:
+        f.write(','.join(['run','program','time','host']+keys)+'\n')
+        for r in runs:
+            for e in r['tools']:
+                row = [r['run'], r['program'], str(r['time']), r['host']]
+                row += ['' if e.get(k) is None else str(e[k]) for k in keys]
+                f.write(','.join(row)+'\n')
+
+###################################################################################
+# Query tool
+###################################################################################
+def main():
+    parser = argparse.ArgumentParser(description='Report trends and drift across runs saved by TAMV, ZTATP and repeatability.', allow_abbrev=False)
+    parser.add_argument('-store',type=str,nargs=1,default=[storeFile],help='Results store to read. Default '+storeFile)
+    parser.add_argument('-program',type=str,nargs=1,default=['TAMV'],choices=['TAMV','ZTATP','repeatability'],help='Which program\'s runs to report on. Default TAMV.')
+    parser.add_argument('-field',type=str,nargs=1,default=['OffsetX'],help='Per tool field to report, for example X, Y, MPP, OffsetX, OffsetY, OffsetZ, or Drift, ErrX, ErrY from -check runs. Default OffsetX.')
+    parser.add_argument('-last',type=int,nargs=1,default=[0],help='Only use the last N runs. Default all.')
+    parser.add_argument('-csv',type=str,nargs=1,default=[None],help='Also write the selected runs to this CSV file.')
+    args=vars(parser.parse_args())
+
+    program = args['program'][0]
+    field   = args['field'][0]
+    runs = loadRuns(program, args['store'][0])
+    if (args['last'][0] > 0): runs = runs[-args['last'][0]:]
+    if (not runs):
+        print('No '+program+' runs found in '+args['store'][0])
+        exit(2)
+    if (args['csv'][0]): writeCSV(runs, args['csv'][0])
+
+    times, values = toolArray(runs, field)
+    s = trend(times, values)
+    print(program+' '+field+' over {0:d} runs, {1:s} to {2:s}'.format(len(runs),
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(times.min())),
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(times.max()))))
+    print('+-----------------------------------------------------------------------------+')
+    print('| T | Runs |   Mean   |  StdDev  |   Min    |   Max    |   Last   | Drift/day |')
+    for t in range(values.shape[1]):
+        if (s['runs'][t] == 0): continue
+        print('| {0:1d} | {1:4d} | {2:8.3f} | {3:8.3f} | {4:8.3f} | {5:8.3f} | {6:8.3f} | {7:9.4f} |'.format(
+            t, s['runs'][t], s['mean'][t], s['std'][t], s['min'][t], s['max'][t], s['last'][t], s['drift'][t]))
+    print('+-----------------------------------------------------------------------------+')
+
+if __name__ == '__main__':
+    main()
@@ -10,27 +10,19 @@
 # Requires network connection to Duet based printer running Duet/RepRap V2 or V3
 #
 
+# Only light modules here.  The large ones (OpenCV, numpy, ...) are loaded by loadLibraries(), 
+# which a thin client handing its job to a running TAMV daemon never calls. 
 import os
 import sys
-import imutils
 import datetime
 import time
-import numpy as np
 import argparse
 import threading
 import queue
-
-try: 
-    import DuetWebAPI as DWA
-except ImportError:
-    print("Python Library Module 'DuetWebAPI.py' is required. ")
-    print("Obtain from https://github.com/DanalEstes/DuetWebAPI ")
-    print("Place in same directory as script, or in Python libpath.")
-    exit(8)
-
-if (os.environ.get('SSH_CLIENT')):
-    print("This script MUST run on the graphics console, not an SSH session.")
-    exit(8)
+import json
+import socket
+import tempfile
+import contextlib
 
 # Define Queue Message Types
 
@@ -43,6 +35,15 @@ CRSH = [5,0]            # Display a crosshair.  Don't even look for circles. Sec
 ROTN = [6]              # Rotate display to next 90 degree increment
 ROTR = [7]              # Rotation Reset to 0
 FOAD = [8]              # Subthread should exit
+MSEQ = [9,0]            # Move sequence number.  Second element is the number of the last move sent to the printer. 
+
+# Calibration (controlled point, MPP, rotation, direction) from the last run, used by -check. 
+lastRunFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),'TAMV_last.json')
+
+# Where a TAMV daemon (-daemon) listens for jobs. 
+daemonSocket = os.path.join(tempfile.gettempdir(),'TAMV-'+str(os.getuid())+'.sock')
+# Options setDeviceOptions() handles.  A daemon is fixed to its own; jobs may only repeat them. 
+deviceOptions = ['duet','camera','res','fps','fourcc','exposure','focus','detectscale','detectgray','record','recordall']
 
 
 
@@ -50,8 +51,7 @@ FOAD = [8]              # Subthread should exit
 ###################################################################################
 # Start of methods 
 ###################################################################################
-def init():
-    os.environ['QT_LOGGING_RULES'] ="qt5ct.debug=false"
+def parseArgs(argv=None):
     # parse command line arguments
     parser = argparse.ArgumentParser(description='Program to allign multiple tools on Duet based printers, using machine vision.', allow_abbrev=False)
     parser.add_argument('-duet',type=str,nargs=1,default=['localhost'],help='Name or IP address of Duet printer. You can use -duet=localhost if you are on the embedded Pi on a Duet3.')
@@ -59,24 +59,111 @@ def init():
     parser.add_argument('-camera',type=int,nargs=1,default=[0],help='Index of /dev/videoN device to be used.  Default 0. ')
     parser.add_argument('-cp',type=float,nargs=2,default=[0.0,0.0],help="x y that will put 'controlled point' on carriage over camera.")
     parser.add_argument('-repeat',type=int,nargs=1,default=[1],help="Repeat entire alignment N times and report statistics")
-    args=vars(parser.parse_args())
-
-    global duet, vidonly, camera, cp, repeat
+    parser.add_argument('-touchplate',type=float,nargs=2,default=[0.0,0.0],help="x y of center of a 15x15mm touch plate. When supplied, Z is probed (as in ZTATP) during the same tool mount used for XY.")
+    parser.add_argument('-pin',type=str,nargs=1,default=['!io5.in'],help='input pin to which wires from nozzles are attached. Only used with -touchplate.')
+    parser.add_argument('-apply',action='store_true',help='Send the computed G10 offsets to the printer, in one command, instead of only printing them.')
+    parser.add_argument('-save',action='store_true',help='Save the applied offsets with M500 P10. Implies -apply.')
+    parser.add_argument('-verify',action='store_true',help='After applying, mount each tool once more and report the residual error. Implies -apply.')
+    parser.add_argument('-check',action='store_true',help='Quick drift check using the calibration saved by the last run. Only tools that have drifted are re-aligned.')
+    parser.add_argument('-threshold',type=float,nargs=1,default=[0.05],help='Drift, in mm, above which -check re-aligns a tool. Default 0.05.')
+    parser.add_argument('-results',type=str,nargs=1,default=[None],help='Results store this run is appended to. Default TAMV_results.jsonl, next to TAMV.py.')
+    parser.add_argument('-record',type=str,nargs=1,default=[None],help='Directory to record camera frames and detections into. Only frames around detection failures are kept, unless -recordall.')
+    parser.add_argument('-recordall',action='store_true',help='With -record, keep every frame.')
+    parser.add_argument('-res',type=int,nargs=2,default=[0,0],help='Camera resolution to request, width height. Default is whatever the driver picks.')
+    parser.add_argument('-fps',type=int,nargs=1,default=[0],help='Camera frame rate to request.')
+    parser.add_argument('-fourcc',type=str,nargs=1,default=[None],choices=['MJPG','YUYV'],help='Camera pixel format to request.')
+    parser.add_argument('-exposure',type=float,nargs=1,default=[None],help='Lock camera exposure at this (driver specific) value.')
+    parser.add_argument('-focus',type=float,nargs=1,default=[None],help='Lock camera focus at this (driver specific) value.')
+    parser.add_argument('-detectscale',type=float,nargs=1,default=[1.0],help='Run circle detection on the frame scaled by this factor, e.g. 0.5. Results are mapped back to full resolution.')
+    parser.add_argument('-detectgray',action='store_true',help='Run circle detection on a grayscale copy of the frame.')
+    parser.add_argument('-trackvar',type=float,nargs=1,default=[0.1],help='Act on the filtered circle position once its variance, in pixels squared, is below this. Default 0.1.')
+    parser.add_argument('-centertol',type=float,nargs=1,default=[0.3],help='A tool is centered when its filtered position is within this many pixels of the frame center. Default 0.3.')
+    parser.add_argument('-lens',action='store_true',help='Use a lens distortion model to center each tool in one move. The model is calibrated with a grid of jogs the first time, then cached per camera.')
+    parser.add_argument('-lenscal',action='store_true',help='Recalibrate the lens model, even if one is cached. Implies -lens.')
+    parser.add_argument('-lensspan',type=float,nargs=1,default=[1.0],help='Lens calibration grid extends this many mm each way from the start point. Default 1.0.')
+    parser.add_argument('-daemon',action='store_true',help='Stay resident with camera, detector and printer connection open, and run jobs sent by later TAMV commands.')
+    parser.add_argument('-stopdaemon',action='store_true',help='Tell a running TAMV daemon to exit.')
+    parser.add_argument('-nodaemon',action='store_true',help='Run here, even if a TAMV daemon is running.')
+    return(vars(parser.parse_args(argv)))
+
+def setDeviceOptions(args):
+    # Options that belong to the camera, video thread and printer connection. 
+    # A daemon takes these from its own command line, not from the jobs it is sent. 
+    global duet, camera, camProfile, detectScale, detectGray, record, recordAll
     duet     = args['duet'][0]
-    vidonly  = args['vidonly']
     camera    = args['camera'][0]
+    camProfile = {'width':args['res'][0], 'height':args['res'][1], 'fps':args['fps'][0], 'fourcc':args['fourcc'][0], 
+        'exposure':args['exposure'][0], 'focus':args['focus'][0]}
+    detectScale = args['detectscale'][0]
+    detectGray  = args['detectgray']
+    record   = args['record'][0]
+    recordAll = args['recordall']
+
+def setOptions(args):
+    # Options for one alignment run. 
+    global vidonly, cp, repeat, tp, pin, apply, save, verify, check, threshold, results, trackVar, centerTol, useLens, lensCal, lensSpan
+    vidonly  = args['vidonly']
     cp       = args['cp']
     repeat   = args['repeat'][0]
+    tp       = args['touchplate']
+    pin      = args['pin'][0]
+    save     = args['save']
+    verify   = args['verify']
+    apply    = args['apply'] or save or verify
+    check    = args['check']
+    threshold = args['threshold'][0]
+    results  = args['results'][0]
+    trackVar    = args['trackvar'][0]
+    centerTol   = args['centertol'][0]
+    lensCal  = args['lenscal']
+    useLens  = args['lens'] or lensCal
+    lensSpan = args['lensspan'][0]
+
+    if (check and tp[1] != 0):
+        print("-check does not probe Z; ignoring -touchplate.")
+        tp = [0.0,0.0]
+    if (check and not os.path.exists(lastRunFile)):     # Before the camera and printer are started. 
+        print("-check requires the results of a previous full run, and "+lastRunFile+" was not found.")
+        exit(8)
 
+def loadLibraries():
     print("Startup may take a few moments: Loading libraries; some of them are very large.")
+    global np, imutils, DWA, cv2, Camera, ResultsStore, Tracker, LensModel, Geometry
+    import numpy as np
+    import imutils
+    try: 
+        import DuetWebAPI as DWA
+    except ImportError:
+        print("Python Library Module 'DuetWebAPI.py' is required. ")
+        print("Obtain from https://github.com/DanalEstes/DuetWebAPI ")
+        print("Place in same directory as script, or in Python libpath.")
+        exit(8)
     try:
-        global cv2
         import cv2
     except:
         print("Import for CV2 failed.  Please install openCV")
         print("You may wish to use https://github.com/DanalEstes/PiInstallOpenCV")
         exit(8)
+    import Camera
+    import ResultsStore
+    import Tracker
+    import LensModel
+    import Geometry
+
+def startVideo():
+    if (os.environ.get('SSH_CLIENT')):
+        print("This script MUST run on the graphics console, not an SSH session.")
+        exit(8)
+    os.environ['QT_LOGGING_RULES'] ="qt5ct.debug=false"
 
+    global recorder, vidRot, moveSeq
+    vidRot   = 0    # Our copy of the rotation the subtask is applying to the video. 
+    moveSeq  = 0    # Count of moves sent, so recorded frames can be matched to them. 
+    recorder = None
+    if (record):
+        import FrameRecorder
+        recorder = FrameRecorder.FrameRecorder(record, keepAll=recordAll)
+        print("Recording frames to "+recorder.path)
 
     # Set up queues to talk to subthread. 
     global txq, rxq
@@ -87,8 +174,7 @@ def init():
     vidStrThr = threading.Thread(target=runVideoStream)
     vidStrThr.start()
 
-    if(vidonly): vidWindow()
-
+def connectPrinter():
     # Get connected to the printer.
     print('Attempting to connect to printer at '+duet)
     global printer
@@ -96,9 +182,18 @@ def init():
     if (not printer.printerType()):
         print('Device at '+duet+' either did not respond or is not a Duet V2 or V3 printer.')
         exit(2)
-    printer = DWA.DuetWebAPI('http://'+duet)
     print("Connected to a Duet V"+str(printer.printerType())+" printer at "+printer.baseURL())
 
+def init(args):
+    setDeviceOptions(args)
+    setOptions(args)
+    loadLibraries()
+    startVideo()
+
+    if(vidonly): vidWindow()
+
+    connectPrinter()
+
     print('')
     print('#########################################################################')
     print('# Important:                                                            #')
@@ -147,12 +242,14 @@ def vidWindow():
 
 
 def createDetector(t1=20,t2=200, all=0.5, area=200):
+    global detectorSettings     # Recorded with the results of each run. 
+    detectorSettings = {'t1':t1, 't2':t2, 'all':all, 'area':area}
         # Setup SimpleBlobDetector parameters.
     params = cv2.SimpleBlobDetector_Params()
     params.minThreshold = t1;          # Change thresholds
     params.maxThreshold = t2;
     params.filterByArea = True         # Filter by Area.
-    params.minArea = area
+    params.minArea = area * detectScale**2  # Area is in pixels of the (possibly scaled) image detection runs on. 
     params.filterByCircularity = True  # Filter by Circularity
     params.minCircularity = all
     params.filterByConvexity = True    # Filter by Convexity
@@ -168,24 +265,18 @@ def createDetector(t1=20,t2=200, all=0.5, area=200):
 
 
 
-def vectDist(xy1,xy2):
-    # Final rounding and int() because we are really calculating pixels here. 
-    # Probably some of these 'float()' casts are overkill; still, better to be explicit. 
-    return int(np.around(np.sqrt(abs( \
-        (float(xy2[0]) - float(xy1[0])) ** float(2) + \
-        (float(xy2[1]) - float(xy1[1])) ** float(2)   \
-        ))))
-
 def printKeypointXYR(keypoints):
     for i in range(len(keypoints)):
         print("Keypoint "+str(i)+" XY = ",np.around(keypoints[i].pt,3))
         print("Keypoints "+str(i)+" R = ",np.around(keypoints[i].size/2,3))
 
 def controlledPoint():
+    global vidRot
     printer.gCode("T-1 ")   # Un Mount any/all tools
     txq.put([STFU])         # Tell subtask not to send us circle messages. 
     txq.put([CRSH,True])    # Tell subtask to display a cross hair reticle. 
     txq.put([ROTR])         # Tell subtask reset rotation. 
+    vidRot = 0
     # Get user to position the first tool over the camera.
     print('#########################################################################')
     print('# 1) Using Duet Web, jog until your controlled point appears.           #')
@@ -208,14 +299,153 @@ def controlledPoint():
     except:
         raise
 
+def moveSent():
+    # Tell subtask a move went out, so recorded frames carry which move they follow. 
+    global moveSeq
+    moveSeq += 1
+    txq.put([MSEQ,moveSeq])
+
+def positionTool(tool):
+    if (tp[1] != 0): 
+        printer.gCode("G1 F1000 Z{0:1.3f} ".format(np.around(CPCoords['Z'],3)))  # Z probing left the bed near the nozzle; back to camera height before any tool change or travel.
+    printer.gCode("T{0:d} ".format(tool))           # Mount correct tool
+    printer.gCode("G1 F5000 X{0:1.3f} ".format(np.around(CPCoords['X'],3)))     # X move first to avoid hitting parked tools. 
+    printer.gCode("G1 F5000 Y{0:1.3f} ".format(np.around(CPCoords['Y'],3)))     # Position Tool in Frame
+    if (tp[1] != 0): 
+        printer.gCode("G1 F1000 Z{0:1.3f} ".format(np.around(CPCoords['Z'],3)))  # Again, with this tool's offset in effect.
+    moveSent()
+
+def averageFrames(frames=16, settle=2):
+    # Average circle position over several frames, for when we only need to look, not move. 
+    # The first settle frames are dropped; they may have been captured before the last move ended. 
+    avg = [0,0]
+    count = -settle
+    while(not rxq.empty()): rxq.get()   # re-sync: Ignore any frame messages that came in while we were doing other things. 
+    txq.put([TTMB])  # Tell subtask to send us circle messages. 
+    while (count < frames):
+        if (rxq.empty()): 
+            txq.put([TTMB])  # Tell subtask to send us circle messages. 
+            time.sleep(.1)
+            continue
+        qmsg=rxq.get()
+        if(not qmsg[0] == FRDT): 
+            print("Skipping unknown queue message header ",qmsg[0])  # Should never happen.  Still check. 
+            continue
+        count += 1
+        if (count <= 0): continue
+        avg[0] += qmsg[1][0]
+        avg[1] += qmsg[1][1]
+        target = qmsg[2]
+    txq.put([STFU])  # Tell subtask not to send us circle messages. 
+    return(np.around([avg[0]/count, avg[1]/count],3), target)
+
+def restoreRotation(rot):
+    # Put the video rotation back to what a previous calibration found. 
+    global vidRot
+    if (vidRot == rot): return
+    txq.put([ROTR])
+    for i in range(rot // 90): txq.put([ROTN])
+    vidRot = rot
+
+def measureTool(tool,cal,frames=16):
+    # Measure how far a tool is from center using the calibration from eachTool(). 
+    # No rotation or direction discovery, and no moves other than getting it on camera. 
+    txq.put([STFU])  # Tell subtask not to send us circle messages. 
+    txq.put([CRSH,False])   # Tell subtask to stop displaying a cross hair reticle. 
+    useModel = cal.get('LENS') and lens is not None
+    restoreRotation(lens['rot'] if useModel else cal['ROT'])
+    print("Mounting tool T{0:d} to measure offsets. ".format(tool))
+    positionTool(tool)
+    printer.gCode('M400')   # Wait for the tool change and travel to finish; gCode() returns once they are queued. 
+    avg, target = averageFrames(frames)
+    if (useModel):
+        m = LensModel.apply(lens,[target,avg])
+        err = np.around(m[0]-m[1],3)
+    else:
+        err = np.around(Geometry.pixelsToMM(avg, target, cal['MPP'], cal['DRCTN']),3)
+    print("Error for T{0:d} = X{1:-1.3f} Y{2:-1.3f} mm".format(tool,err[0],err[1]))
+    return(err)
+
+def checkTools():
+    # Measure every tool where the current offsets should put it; fully re-align only the ones that drifted. 
+    # What was measured is kept in checkDrift, for the results store, whether or not the tool was re-aligned. 
+    global checkDrift
+    checkDrift = {}
+    coords = []
+    for t in range(printer.getNumTools()):
+        if (t >= len(lastRun['tools'])):
+            print("T{0:d} was not in the last run, aligning it.".format(t))
+            toolStart = time.time()
+            coords.append(eachTool(t,0))
+            coords[t]['Seconds'] = np.around(time.time()-toolStart,3)
+            continue
+        err = measureTool(t,lastRun['tools'][t],frames=8)
+        drift = np.around(Geometry.norm(err),3)
+        checkDrift[t] = {'ErrX':float(err[0]), 'ErrY':float(err[1]), 'Drift':float(drift)}
+        if (drift > threshold):
+            print("T{0:d} has drifted {1:1.3f} mm, re-aligning.".format(t,drift))
+            toolStart = time.time()
+            coords.append(eachTool(t,0))
+            coords[t]['Seconds'] = np.around(time.time()-toolStart,3)
+        else:
+            coords.append(None)
+    return(coords)
+
+def loadLastRun():
+    with open(lastRunFile) as f:
+        return(json.load(f))
+
+def saveLastRun(coords):
+    # Keep the calibration of tools that -check did not need to re-align. 
+    tools = []
+    for t in range(len(coords)):
+        if (coords[t] is None):
+            tools.append(lastRun['tools'][t])
+        else:
+            tools.append({'MPP':coords[t]['MPP'], 'ROT':coords[t]['ROT'], 'DRCTN':coords[t]['DRCTN'], 'LENS':coords[t].get('LENS',False)})
+    with open(lastRunFile,'w') as f:
+        json.dump({'CP':CPCoords, 'tools':tools}, f, indent=2)
+
+def setupLens():
+    # Load the lens model for this camera, or calibrate one by jogging tool 0 over a grid. 
+    global lens
+    txq.put([STFU])  # Tell subtask not to send us circle messages. 
+    txq.put([CRSH,False])   # Tell subtask to stop displaying a cross hair reticle. 
+    print("Mounting tool T0 for the lens model. ")
+    positionTool(0)
+    printer.gCode('M400')   # Wait for the moves to finish before looking. 
+    avg, target = averageFrames()
+    key = LensModel.lensKey(camera, target, vidRot)
+    lens = None if lensCal else LensModel.load(key)
+    if (lens is not None):
+        print("Using cached lens model for "+key)
+        return
+
+    print("Calibrating lens model for "+key+"; {0:d} moves.".format(len(LensModel.gridOffsets(lensSpan))))
+    base = printer.getCoords()
+    pixels = []
+    moves = LensModel.gridOffsets(lensSpan)
+    for d in moves:
+        printer.gCode("G1 F5000 X{0:1.3f} Y{1:1.3f} ".format(base['X']+d[0], base['Y']+d[1]))
+        moveSent()
+        printer.gCode('M400')   # Every grid point is fitted into the cached model for good; only sample it standing still. 
+        avg, target = averageFrames()
+        pixels.append(avg)
+    printer.gCode("G1 F5000 X{0:1.3f} Y{1:1.3f} ".format(base['X'], base['Y']))
+    moveSent()
+    lens = LensModel.fit(pixels, moves, target, vidRot)
+    print("Lens model fit RMS = {0:1.4f} mm, MM per Pixel at center = {1:7.4f}".format(lens['rms'], LensModel.mmPerPixel(lens)))
+    LensModel.save(key, lens)
+
 def eachTool(tool,rep):
+    global vidRot
     txq.put([STFU])  # Tell subtask not to send us circle messages. 
     txq.put([CRSH,False])   # Tell subtask to stop displaying a cross hair reticle. 
 
-    avg=[0,0]
+    tracker = Tracker.NozzleTracker()
     guess  = [1,1];  # Millimeters.
     target = [720/2, 480/2] # Pixels. Will be recalculated from frame size.
-    drctn  = [-1,-1]  # Either 1 or -1, which we must figure out from the initial moves
+    drctn  = np.array([-1,-1])  # Either 1 or -1, which we must figure out from the initial moves
     xy     = [0,0]
     oldxy  = xy
     state = 0 # State machine for figuring out image rotation to carriage XY move mapping.
@@ -226,9 +456,8 @@ def eachTool(tool,rep):
     print('')
     print('')
     print("Mounting tool T{0:d} for repeat pass {1:d}. ".format(tool,rep+1))
-    printer.gCode("T{0:d} ".format(tool))           # Mount correct tool
-    printer.gCode("G1 F5000 X{0:1.3f} ".format(np.around(CPCoords['X'],3)))     # X move first to avoid hitting parked tools. 
-    printer.gCode("G1 F5000 Y{0:1.3f} ".format(np.around(CPCoords['Y'],3)))     # Position Tool in Frame
+    if (lens is not None): restoreRotation(lens['rot'])    # The model only holds at the rotation it was fitted at. 
+    positionTool(tool)
     while(not rxq.empty()): rxq.get()   # re-sync: Ignore any frame messages that came in while we were doing other things. 
     txq.put([TTMB])  # Tell subtask to send us circle messages. 
 
@@ -254,25 +483,43 @@ def eachTool(tool,rep):
             continue
 
         # Found one and only one circle.  Process it.
-        xy = qmsg[1]
         target = qmsg[2]
 
-        # Keep track of center of circle and average across many circles
-        avg[0] += xy[0]
-        avg[1] += xy[1]
+        # Filter the center of circle across frames; act as soon as the estimate is steady, 
+        # and at the latest after 16 frames, as before. 
+        pos, var = tracker.update(qmsg[1])
         count += 1
-        if (count > 15):
-            avg[0] /= count
-            avg[1] /= count
-            avg = np.around(avg,3)
+        if (tracker.settled(trackVar) or count > 15):
+            xy = pos                # Sub-pixel; the filter is what makes it worth keeping. 
+            centered = Geometry.dist(xy,target) < centerTol
             #print('')
             #print("state = ",state)
-            #print("Average Pixel Position = X{0:7.3f}  Y{1:7.3f} ".format(avg[0],avg[1]))
+            #print("Filtered Pixel Position = X{0:7.3f}  Y{1:7.3f}  Var {2:5.3f} ".format(pos[0],pos[1],np.max(var)))
+            if (lens is not None):  # The lens model already knows rotation, direction and scale everywhere in the frame. 
+                m = LensModel.apply(lens,[target,xy])
+                guess = np.around(m[0]-m[1],3)
+                if (centered or (guess[0] == 0.0 and guess[1] == 0.0)):
+                    txq.put([STFU])
+                    print("Found Center of Image at offset coordinates ",printer.getCoords())
+                    c=printer.getCoords()
+                    c['MPP'] = LensModel.mmPerPixel(lens)
+                    c['ROT'] = vidRot
+                    c['DRCTN'] = [1,1]
+                    c['LENS'] = True
+                    return(c)
+                printer.gCode("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
+                moveSent()
+                while(not rxq.empty()): rxq.get()   # re-sync: Ignore any frame messages from before the move. 
+                print("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
+                tracker.reset()
+                count = 0
+                continue
             #print("Target        Position = X{0:7.3f}  Y{1:7.3f} ".format(target[0],target[1]))
             if (state == 0):  # Finding Rotation: Collected frames before first move.
                 print("Initiating a small X move to calibrate camera to carriage rotation.")
                 oldxy = xy
                 printer.gCode("G91 G1 X-0.5 G90 ")
+                moveSent()
                 while(not rxq.empty()): rxq.get()   # re-sync: Ignore any frame messages that came in while we were doing other things. 
                 txq.put([TTMB])  # Tell subtask to send us circle messages. 
                 state += 1
@@ -284,43 +531,84 @@ def eachTool(tool,rep):
                 #print("oldY = ",oldxy[1])
                 #print("X movement detected = ",abs(oldxy[0]-xy[0]))
                 #print("Y movement detected = ",abs(oldxy[1]-xy[1]))
-                if (abs(int(oldxy[0])-int(xy[0])) > 2+abs(int(oldxy[1])-int(xy[1]))):
+                moved = np.abs(np.subtract(xy,oldxy))   # Image X and Y components of the X jog. 
+                if (moved[0] > 2+moved[1]):
                     print("Found X movement via rotation, will now calibrate camera to carriage direction.")
-                    mpp = 0.5/float(vectDist(xy,oldxy))
+                    mpp = 0.5/Geometry.dist(xy,oldxy)
                     print("MM per Pixel discovered = {0:7.4f}".format(mpp) )
-                    ppm = float(vectDist(xy,oldxy))/0.5
+                    ppm = Geometry.dist(xy,oldxy)/0.5
                     print("Pixel per MM discovered = {0:7.4f}".format(ppm) )
                     state += 1
                     oldxy = xy
-                    drctn = [1,1]
+                    drctn = np.array([1,1])
                 else:
                     print("Camera to carriage movement axis incompatiabile... will rotate image and calibrate again.")
                     txq.put([STFU])  # Tell subtask not to send us circle messages.
                     txq.put([ROTN]) 
+                    vidRot = (vidRot + 90) % 360
                     state = 0 #start over.
 
             elif (state == 2): # Incrementally attempt to center the nozzle.
-                for j in [0,1]:
-                    if (abs(target[j]-oldxy[j]) < abs(target[j]-xy[j])): # Are we going the wrong way?  Depends on camera orientation. 
-                        print("Detected movement away from target, now reversing "+'XY'[j])
-                        drctn[j] = -drctn[j]                         # If we are getting further away, reverse!
-                    #print("Direction         Factor = X{0:-d}  Y{1:-d} ".format(drctn[0],drctn[1]))
-                    guess[j] = np.around((target[j]-xy[j])/(ppm*2),3)
-                    guess[j] = guess[j] * drctn[j]  # Force a direction
-                printer.gCode("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
-                print("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
+                away = np.abs(np.subtract(target,oldxy)) < np.abs(np.subtract(target,xy))  # Are we going the wrong way?  Depends on camera orientation. 
+                for j in np.flatnonzero(away):
+                    print("Detected movement away from target, now reversing "+'XY'[j])
+                drctn = np.where(away, -drctn, drctn)               # If we are getting further away, reverse!
+                #print("Direction         Factor = X{0:-d}  Y{1:-d} ".format(drctn[0],drctn[1]))
+                guess = np.around(Geometry.pixelsToMM(xy, target, mpp/2, drctn),3)    # Half way, and force a direction
+                if (not centered and (guess[0] != 0.0 or guess[1] != 0.0)):
+                    printer.gCode("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
+                    moveSent()
+                    while(not rxq.empty()): rxq.get()   # re-sync: Frames from before the move would only be rejected by the tracker. 
+                    print("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
                 oldxy = xy
-                if ((np.around(guess[0],3) == 0.0) and (np.around(guess[1],3) == 0.0)):
+                if (centered or (guess[0] == 0.0 and guess[1] == 0.0)):
                     txq.put([STFU])
                     #printer.gCode("G10 P{0:d} X0Y0 ".format(tool))  # Remove tool offsets, before we capture position. 
                     print("Found Center of Image at offset coordinates ",printer.getCoords())
                     c=printer.getCoords()
                     c['MPP'] = mpp
+                    c['ROT'] = vidRot
+                    c['DRCTN'] = drctn.tolist()
                     return(c)
 
-            avg = [0,0]
+            tracker.reset()
             count = 0
 
+def probeToolZ(tool):
+    # Z probe the tool that eachTool() just aligned in XY, without parking it first.
+    # One mount per tool, instead of one for TAMV and another for ZTATP.
+    printer.resetEndstops()
+    printer.gCode('M400')                                # Wait for planner to empty
+    printer.gCode('G91 G0 Z10 F1000 G90')                # Lower bed to avoid collision on the way to the plate
+    return(ZTATP.probeMountedTool(tool))
+
+def saveResults():
+    run = ResultsStore.newRun('TAMV', {'duet':duet, 'camera':camera, 'repeat':repeat, 'check':check, 'threshold':threshold, 
+        'touchplate':tp, 'detector':detectorSettings, 'capture':camProfile, 'detectscale':detectScale, 'detectgray':detectGray})
+    run['CP'] = CPCoords
+    for r in range(len(toolCoords)):
+        for t in range(len(toolCoords[r])):
+            c = toolCoords[r][t]
+            d = checkDrift.get(t, {}) if (check and r == 0) else {}
+            if (c is None):             # -check found no drift; keep what it measured. 
+                run['tools'].append(dict({'tool':t, 'pass':r}, **d))
+                continue
+            e = {'tool':t, 'pass':r, 'X':c['X'], 'Y':c['Y'], 'MPP':c['MPP'], 'ROT':c['ROT'], 'Seconds':c['Seconds']}
+            if ('ZProbe' in c): e['ZProbe'] = c['ZProbe']
+            if (r == 0): e.update(offsets[t])
+            e.update(d)
+            run['tools'].append(e)
+    if (repeat > 1):
+        st = Geometry.stats(coordArray(['X','Y']))
+        for t in range(len(toolCoords[0])):
+            run['stats'][t] = {a:{k:st[k][t][i] for k in st} for i, a in enumerate(['X','Y'])}
+    run['timings'] = {'total':time.time()-startTime}
+    ResultsStore.appendRun(run, results or ResultsStore.storeFile)
+
+def coordArray(keys):
+    # toolCoords as a repeats x tools x keys array, for statistics over all of it at once. 
+    return(np.array([[[c[k] for k in keys] for c in toolCoords[r]] for r in range(repeat)], dtype=float))
+
 def repeatReport():
     ###################################################################################
     # Report on repeated executions
@@ -330,18 +618,13 @@ def repeatReport():
     print('+-------------------------------------------------------------------------------------------+')
     print('|   |                           X                   |                   Y                   |')
     print('| T |  MPP  |   Avg   |   Max   |   Min   |  StdDev |   Avg   |   Max   |   Min   |  StdDev |')
-    for t in range(printer.getNumTools()):    
+    st = Geometry.stats(coordArray(['MPP','X','Y']))     # Each is tools x [MPP, X, Y]
+    for t in range(len(toolCoords[0])):    
         #      | 0 | 123 |123.456 | 123.456 | 123.456 | 123.456 | 123.456 | 123.456 | 123.456 | 123.456 | 
         print('| {0:1.0f} '.format(t),end='')
-        print('| {0:3.3f} '.format(np.around(np.average([toolCoords[i][t]['MPP'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.average([toolCoords[i][t]['X'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.max([toolCoords[i][t]['X'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.min([toolCoords[i][t]['X'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.std([toolCoords[i][t]['X'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.average([toolCoords[i][t]['Y'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.max([toolCoords[i][t]['Y'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.min([toolCoords[i][t]['Y'] for i in range(repeat)]),3)),end='')
-        print('| {0:7.3f} '.format(np.around(np.std([toolCoords[i][t]['Y'] for i in range(repeat)]),3)),end='')
+        print('| {0:3.3f} '.format(st['avg'][t][0]),end='')
+        for j in [1,2]:
+            print('| {0:7.3f} | {1:7.3f} | {2:7.3f} | {3:7.3f} '.format(st['avg'][t][j],st['max'][t][j],st['min'][t][j],st['std'][t][j]),end='')
         print('|')
     print('+-------------------------------------------------------------------------------------------+')
     print('Note: Repeatability cannot be better than one pixel, see Millimeters per Pixel, above.')
@@ -368,15 +651,20 @@ def runVideoStream():
     OKTS=0          # OK To Send
     XRET=0          # Draw a cross hair reticle.
     nocircle = 0    # Counter of frames with no circle.  
+    mseq = 0        # Move sequence number, for the recorder. 
 
     detector = createDetector()
-    vs = cv2.VideoCapture(camera)
+    vs = Camera.openCamera(camera, **camProfile)
+    Camera.measureLatency(vs, detector, scale=detectScale, gray=detectGray)
 
     while True:
         # Process Queue messages before frames. 
         if (not txq.empty()): 
             qmsg=txq.get()
-            if (qmsg[0] == FOAD): return(0)
+            if (qmsg[0] == FOAD): 
+                if (recorder): recorder.close()
+                return(0)
+            if (qmsg[0] == MSEQ): mseq = qmsg[1]
             if (qmsg[0] == STFU): OKTS = 0
             if (qmsg[0] == TTMB): OKTS = 1
             if (qmsg[0] == CRSH): XRET = qmsg[1]
@@ -401,7 +689,7 @@ def runVideoStream():
         if (mono): frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         if (blur[0]): frame = cv2.medianBlur(frame, blur[1])
 
-        keypoints = detector.detect(frame)
+        keypoints = Camera.detect(detector, frame, detectScale, detectGray)
 
         # draw the timestamp on the frame AFTER the circle detector! Otherwise it finds the circles in the numbers.
         frame = putText(frame,'timestamp',offsety=99)
@@ -422,6 +710,8 @@ def runVideoStream():
             key = cv2.waitKey(1) # Required to get frames to display.
             continue
 
+        if (recorder): recorder.add(fg, rot, keypoints, mseq, OKTS == 1)   # No circle during moves and tool changes is not a failure. 
+
         if(nocircle> 25): 
             showBlobs(fg)
             nocircle = 0 
@@ -472,7 +762,7 @@ def runVideoStream():
         rd = int(round(time.time() * 1000))
 
         # and tell our parent.
-        if(OKTS): rxq.put([FRDT,xy,target]) # Message type 1, a set of XY coordinates, the target coordinates
+        if(OKTS): rxq.put([FRDT,np.array(keypoints[0].pt),target]) # Message type 1, sub-pixel XY of the circle, the target coordinates
 
 
 def showBlobs(im):
@@ -522,45 +812,217 @@ def putText(frame,text,color=(0, 0, 255),offsetx=0,offsety=0,stroke=1):  # Offse
 
 
 
+def alignTools():
+    # One complete alignment run: find the controlled point, align every tool, report, apply. 
+    global CPCoords, toolCoords, offsets, poffs, lastRun, startTime, repeat
+    startTime = time.time()
+
+    if (tp[1] != 0):
+        # Combined XY+Z run. Reuse the ZTATP probe routines against our printer connection. 
+        global ZTATP
+        import ZTATP
+        ZTATP.prt = printer
+        ZTATP.tp  = tp
+        ZTATP.pin = pin
+
+    global lens
+    lens = None
+    if (check): lastRun = loadLastRun()
+    if (cp[1] != 0):
+        CPCoords = {'X':cp[0], 'Y':cp[1]}   # Load -cp command line arg into dict like printerGetCoords
+    elif (check):
+        CPCoords = lastRun['CP']            # Same controlled point as the run being checked. 
+    else:
+        controlledPoint()                   # Command line -cp not supplied, find with help of user and camera. 
+
+    if (tp[1] != 0):
+        CPCoords['Z'] = printer.getCoords()['Z']   # Camera height, so it can be restored after each Z probe. 
+        poffs = ZTATP.probePlate()
+
+    if (useLens or (check and any([t.get('LENS') for t in lastRun['tools']]))): setupLens()
+
+    # Now look at each tool.
+    toolCoords = []
+    if (check):
+        repeat = 1
+        toolCoords.append(checkTools())
+    for r in range(len(toolCoords),repeat):
+        toolCoords.append([])
+        for t in range(printer.getNumTools()):
+            toolStart = time.time()
+            toolCoords[r].append(eachTool(t,r))
+            toolCoords[r][t]['Seconds'] = np.around(time.time()-toolStart,3)
+            if (tp[1] != 0): toolCoords[r][t]['ZProbe'] = probeToolZ(t)
+
+    print("Unmounting last tool")
+    printer.gCode("T-1 ")
+    if (tp[1] != 0): printer.resetEndstops()
+
+    ###################################################################################
+    # End of all vision, etc.  Now calculate and report.
+    ###################################################################################
+    print()
+    g10 = []
+    offsets = {}
+    for t in range(0,len(toolCoords[0])):
+        if (toolCoords[0][t] is None): continue     # -check found no drift. 
+        toolOffsets = printer.getG10ToolOffset(t)
+        x = np.around((CPCoords['X'] + toolOffsets['X']) - toolCoords[0][t]['X'],3)
+        y = np.around((CPCoords['Y'] + toolOffsets['Y']) - toolCoords[0][t]['Y'],3)
+        if (tp[1] != 0):
+            # Same as ZTATP, except the existing Z offset was left in place while probing, so add it back. 
+            z = np.around((poffs + toolOffsets['Z']) - toolCoords[0][t]['ZProbe'] - 0.1,2)
+            g10.append("G10 P{0:d} X{1:1.3f} Y{2:1.3f} Z{3:1.2f} ".format(t,x,y,z))
+            offsets[t] = {'OffsetX':x, 'OffsetY':y, 'OffsetZ':z}
+        else:
+            g10.append("G10 P{0:d} X{1:1.3f} Y{2:1.3f} ".format(t,x,y))
+            offsets[t] = {'OffsetX':x, 'OffsetY':y}
+        print(g10[-1])
+    if (not g10): print("All tools are within {0:1.3f} mm. Nothing to align.".format(threshold))
+    print()
+    saveLastRun(toolCoords[0])
+
+    if (apply and g10):
+        print("Applying offsets to printer.")
+        printer.gCode(''.join(g10))     # One command for all tools.
+        if (save): 
+            print("Saving offsets with M500 P10.")
+            printer.gCode("M500 P10 ")
+        if (verify):
+            print("Verifying offsets.")
+            for t in range(0,len(toolCoords[0])):
+                if (toolCoords[0][t] is None): continue
+                measureTool(t,toolCoords[0][t])
+            print("Unmounting last tool")
+            printer.gCode("T-1 ")
+        print()
+
+    if (repeat > 1): repeatReport()    
+    saveResults()
+
+    print('')
+    print('If your camera is in a consistent location, next time you run TAMV, ')
+    print('you can optionally supply -cp {0:1.3f} {1:1.3f} '.format(CPCoords['X'],CPCoords['Y']))
+    print('Adding this will cause TAMV to skip all interaction, and attempt to align all tools on its own.')
+    print('(This is really the x y of your camera)')
+
 ###################################################################################
-# End of method definitions
-# Start of Main Code
+# Daemon.  Keeps the camera, detector and printer connection warm between runs.
 ###################################################################################
-init()
-if (cp[1] == 0):
-    controlledPoint()                   # Command line -cp not supplied, find with help of user and camera. 
-else:
-    CPCoords = {'X':cp[0], 'Y':cp[1]}   # Load -cp command line arg into dict like printerGetCoords
-
+class SocketWriter:
+    # Just enough of a file for print() to stream a job's output to its client as it happens. 
+    # If the client goes away (Ctrl+C, dropped SSH), the rest of the output is dropped and the 
+    # job runs to completion, rather than leaving a tool mounted half way through. 
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed = False
+    def write(self, text):
+        if (not self.closed):
+            try:
+                self.conn.sendall(text.encode())
+            except OSError:
+                self.closed = True
+                sys.__stdout__.write("Client went away; finishing the job without it.\n")
+        return(len(text))
+    def flush(self):
+        pass
+
+def runDaemon(args):
+    global daemonArgs
+    daemonArgs = args
+    setDeviceOptions(args)
+    loadLibraries()
+    startVideo()
+    connectPrinter()
+
+    if (os.path.exists(daemonSocket)): os.unlink(daemonSocket)    # Left behind by a daemon that did not exit cleanly. 
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(daemonSocket)
+    srv.listen(1)
+    print("TAMV daemon ready. Run TAMV as usual and it will use this daemon; -stopdaemon to stop it.")
+    try:
+        while True:
+            conn, addr = srv.accept()
+            with conn:
+                try:
+                    job = json.loads(conn.makefile('r').readline())
+                    if (job.get('stop')): 
+                        conn.sendall(b'\0' + b'0\n')
+                        break
+                    argv = [str(a) for a in job['argv']]
+                except (ValueError, KeyError, TypeError, AttributeError, OSError):
+                    print("Ignoring malformed job.")
+                    continue
+                print("Running job: TAMV "+' '.join(argv))
+                code = runJob(argv, SocketWriter(conn))
+                print("Job finished, exit code "+str(code))
+                try:
+                    conn.sendall(('\0'+str(code)+'\n').encode())
+                except OSError:
+                    pass    # Client went away.  Nothing to tell it. 
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.close()
+        os.unlink(daemonSocket)
+        txq.put([FOAD])
 
-# Now look at each tool.
-toolCoords = []
-for r in range(0,repeat):
-    toolCoords.append([])
-    for t in range(printer.getNumTools()):
-        toolCoords[r].append(eachTool(t,r))
+def runJob(argv, out):
+    # Run one alignment with the client's options, sending everything it prints back to the client. 
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            jobArgs = parseArgs(argv)
+            given = [a.split('=')[0].lstrip('-') for a in argv if a.startswith('-')]
+            differ = [k for k in deviceOptions if k in given and jobArgs[k] != daemonArgs[k]]
+            if (differ):
+                print("This TAMV daemon was started with different "+', '.join(['-'+k for k in differ])+". Run with -nodaemon, or restart the daemon with these options.")
+                return(2)
+            setOptions(jobArgs)
+            if (vidonly or (cp[1] == 0 and not check)):
+                print("A TAMV daemon cannot run interactively. Supply -cp, or use -check, or run with -nodaemon after -stopdaemon.")
+                return(2)
+            alignTools()
+            return(0)
+        except SystemExit as e:     # Anything that would have ended the program only ends the job. 
+            return(e.code if isinstance(e.code,int) else 1)
+        except Exception as e:
+            print("Job failed: "+repr(e))
+            return(1)
+
+def runClient(job):
+    # Hand a job to a running daemon and relay its output.  Returns None if there is no daemon. 
+    if (not os.path.exists(daemonSocket)): return(None)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(daemonSocket)
+    except OSError:
+        return(None)    # Stale socket; daemon is gone. 
+    with conn:
+        conn.sendall((json.dumps(job)+'\n').encode())
+        for line in conn.makefile('r'):
+            if (line.startswith('\0')): return(int(line[1:]))
+            print(line, end='', flush=True)
+    return(1)   # Daemon hung up without finishing. 
 
-print("Unmounting last tool")
-printer.gCode("T-1 ")
 
 ###################################################################################
-# End of all vision, etc.  Now calculate and report.
+# End of method definitions
+# Start of Main Code
 ###################################################################################
-print()
-for t in range(0,len(toolCoords[0])):
-    toolOffsets = printer.getG10ToolOffset(t)
-    x = np.around((CPCoords['X'] + toolOffsets['X']) - toolCoords[0][t]['X'],3)
-    y = np.around((CPCoords['Y'] + toolOffsets['Y']) - toolCoords[0][t]['Y'],3)
-    print("G10 P{0:d} X{1:1.3f} Y{2:1.3f} ".format(t,x,y))
-print()
-
-if (repeat > 1): repeatReport()    
-
-# Tell subtask to exit
-txq.put([FOAD])
-
-print('')
-print('If your camera is in a consistent location, next time you run TAMV, ')
-print('you can optionally supply -cp {0:1.3f} {1:1.3f} '.format(CPCoords['X'],CPCoords['Y']))
-print('Adding this will cause TAMV to skip all interaction, and attempt to align all tools on its own.')
-print('(This is really the x y of your camera)')
\ No newline at end of file
+if __name__ == '__main__':
+    args = parseArgs()
+    if (args['stopdaemon']):
+        if (runClient({'stop':True}) is None): print("No TAMV daemon is running.")
+        exit()
+    if (args['daemon']):
+        runDaemon(args)
+        exit()
+    if (not args['nodaemon']):
+        code = runClient({'argv':sys.argv[1:]})
+        if (code is not None): exit(code)
+
+    init(args)
+    alignTools()
+
+    # Tell subtask to exit
+    txq.put([FOAD])
@@ -0,0 +1,82 @@
+# Per tool position tracker for TAMV.  Between moves the nozzle does not move, so this is a
+# constant position Kalman filter on X and Y (with a little process noise, for settling),
+# that throws away detections too far from the current estimate.
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Every frame gives back a filtered position and its variance, in pixels, so the alignment
+# loop can act as soon as the estimate is good enough, instead of after a fixed frame count.
+# The detection noise is not assumed; it is estimated from the spread of the accepted
+# detections, pooled over every move this tracker has seen, so a steady image settles in a
+# few frames and a noisy one takes as many as it needs.  Nothing is rejected until there are
+# enough detections to say what "too far" is.
+#
+
+import numpy as np
+
+class NozzleTracker:
+    def __init__(self, noise=1.0, process=0.001, gate=4.0, maxRejects=5, prior=2, minNoise=0.01, minSamples=6):
+        self.R0 = noise             # Starting guess at the variance of a single detection, pixels squared.
+        self.Q = process            # Variance added per frame, so the filter can follow small settling.
+        self.gate = gate            # Reject detections more than this many sigma from the estimate.
+        self.maxRejects = maxRejects  # This many rejects in a row means it really moved; start over from them.
+        self.prior = prior          # Weight of R0, in detections, against the measured spread.
+        self.minNoise = minNoise    # Never trust detections more than this, however steady they look.
+        self.minSamples = minSamples  # Accept everything, and do not report settled, until this many detections.
+        self.m2Pool = np.zeros(2)   # Squared deviations and degrees of freedom from before the last reset.
+        self.dofPool = 0
+        self.n = 0
+        self.reset()
+
+    def reset(self):
+        # Call after every move; the old position is no longer any use, but the noise estimate is.
+        if (self.n > 1):
+            self.m2Pool = self.m2Pool + self.m2
+            self.dofPool += self.n - 1
+        self.xy = None
+        self.var = None
+        self.n = 0
+        self.rejects = []
+        self.mean = None            # Running mean and sum of squared deviations of accepted detections.
+        self.m2 = np.zeros(2)
+        self.R = self.noise()
+
+    def noise(self):
+        # Detection noise to use: the prior, pulled toward what has actually been seen.
+        dof = self.dofPool + max(self.n - 1, 0)
+        return(np.maximum((self.prior * self.R0 + self.m2Pool + self.m2) / (self.prior + dof), self.minNoise))
+
+    def update(self, xy):
+        z = np.array(xy, dtype=float)
+        if (self.xy is None):
+            self.xy = z
+            self.mean = z
+            self.var = np.array(self.R)
+            self.n = 1
+            return(self.xy, self.var)
+        p = self.var + self.Q
+        innov = z - self.xy
+        if (self.n >= self.minSamples and np.any(innov**2 > self.gate**2 * (p + self.R))):
+            self.rejects.append(z)
+            if (len(self.rejects) >= self.maxRejects):
+                # Consistently somewhere else: it moved.  Start again from the detections that said so.
+                rejects = self.rejects
+                self.reset()
+                for r in rejects: self.update(r)
+            return(self.xy, self.var)
+        self.rejects = []
+        self.n += 1
+        d = z - self.mean
+        self.mean = self.mean + d / self.n
+        self.m2 = self.m2 + d * (z - self.mean)
+        R = self.noise()
+        p = self.var * R / self.R + self.Q     # The estimate so far was weighted with the old noise; rescale its variance to match.
+        self.R = R
+        k = p / (p + self.R)
+        self.xy = self.xy + k * innov
+        self.var = (1 - k) * p
+        return(self.xy, self.var)
+
+    def settled(self, maxVar):
+        return(self.xy is not None and self.n >= self.minSamples and np.max(self.var) < maxVar)
@@ -22,6 +22,8 @@ except ImportError:
     exit(2)
 import numpy as np
 import argparse
+import time
+import ResultsStore
 
 def init():
     # parse command line arguments
@@ -30,12 +32,18 @@ def init():
     #parser.add_argument('-camera',type=str,nargs=1,choices=['usb','pi'],default=['usb'])
     parser.add_argument('-touchplate',type=float,nargs=2,default=[0.0,0.0],help="x y of center of a 15x15mm touch plate.",required=True)
     parser.add_argument('-pin',type=str,nargs=2,default='!io5.in',help='input pin to which wires from nozzles are attached.')
+    parser.add_argument('-apply',action='store_true',help='Send the computed G10 offsets to the printer, in one command, instead of only printing them.')
+    parser.add_argument('-save',action='store_true',help='Save the applied offsets with M500 P10. Implies -apply.')
+    parser.add_argument('-results',type=str,nargs=1,default=[ResultsStore.storeFile],help='Results store this run is appended to. Default '+ResultsStore.storeFile)
     args=vars(parser.parse_args())
 
-    global duet, camera, tp, pin
+    global duet, camera, tp, pin, apply, save, results
     duet   = args['duet'][0]
     tp     = args['touchplate']
     pin    = args['pin']
+    save   = args['save']
+    apply  = args['apply'] or save
+    results = args['results'][0]
 
 
     # Get connected to the printer.
@@ -87,6 +95,15 @@ def probeTool(tn):
     prt.gCode('G10 P'+str(tn)+' Z0')                 # Remove z offsets from Tool 
     prt.gCode('G91 G0 Z10 F1000 G90')                 # Lower bed to avoid collision
     prt.gCode('T'+str(tn))                           # Pick up Tool 
+    toffs = probeMountedTool(tn)
+    prt.gCode('T-1')
+    prt.gCode('M400')
+    return(toffs)
+# End of probeTool function
+
+def probeMountedTool(tn):
+    # Probe the tool that is already mounted.  Split out of probeTool() so that TAMV can 
+    # probe Z during the same mount it uses for XY, instead of changing tools twice. 
     # Z Axis
     prt.gCode('M558 K0 P9 C"nil"')                   # Undef existing probe
     prt.gCode('M558 K0 P5 C"'+pin+'" F200')          # Define nozzle<>bed wire as probe
@@ -98,28 +115,45 @@ def probeTool(tn):
     prt.gCode('M574 Z1 S1 P"nil"')
     prt.resetEndstops()
     #prt.resetAxisLimits()
-    prt.gCode('T-1')
-    prt.gCode('M400')
     return(toffs)
-# End of probeTool function
+# End of probeMountedTool function
 
 #
 # Main
 #
-init()
+if __name__ == '__main__':
+    startTime = time.time()
+    init()
+
+    run = ResultsStore.newRun('ZTATP', {'duet':duet, 'touchplate':tp, 'pin':pin})
+    poffs = probePlate()
+    toolCoords = []
+    for t in range(prt.getNumTools()):
+        toolStart = time.time()
+        toolCoords.append(probeTool(t))
+        run['tools'].append({'tool':t, 'pass':0, 'ZProbe':toolCoords[t], 'Seconds':np.around(time.time()-toolStart,3)})
+    prt.resetEndstops()
+
+    # Display Results
+    # Actually set G10 offsets
+    print("Plate Offset = "+str(poffs))
+    print()
+    for tn in range(len(toolCoords)):
+        print("Tool Offset for tool "+str(tn)+" is "+str(toolCoords[tn]))
+    print()
+    g10 = []
+    for tn in range(len(toolCoords)):
+        g10.append('G10 P'+str(tn)+' Z'+str(np.around((poffs-toolCoords[tn])-0.1,2))+' ')
+        run['tools'][tn]['OffsetZ'] = np.around((poffs-toolCoords[tn])-0.1,2)
+        print(g10[tn])
 
-poffs = probePlate()
-toolCoords = []
-for t in range(prt.getNumTools()):
-    toolCoords.append(probeTool(t))
-prt.resetEndstops()
+    if (apply):
+        print("Applying offsets to printer.")
+        prt.gCode(''.join(g10))         # One command for all tools.
+        if (save): 
+            print("Saving offsets with M500 P10.")
+            prt.gCode('M500 P10')
 
-# Display Results
-# Actually set G10 offsets
-print("Plate Offset = "+str(poffs))
-print()
-for tn in range(len(toolCoords)):
-    print("Tool Offset for tool "+str(tn)+" is "+str(toolCoords[tn]))
-print()
-for tn in range(len(toolCoords)):
-    print('G10 P'+str(tn)+' Z'+str(np.around((poffs-toolCoords[tn])-0.1,2)))
+    run['PlateOffset'] = poffs
+    run['timings'] = {'total':time.time()-startTime}
+    ResultsStore.appendRun(run, results)
@@ -25,6 +25,8 @@ import datetime
 import time
 import numpy as np
 import DuetWebAPI as DWA
+import ResultsStore
+import Geometry
 
 
 if (os.environ.get('SSH_CLIENT')):
@@ -36,9 +38,12 @@ os.environ['QT_LOGGING_RULES'] ="qt5ct.debug=false"
 # Globals.
 cameraCoords = []
 
-# initialize the video stream and allow the cammera sensor to warmup
-vs = cv2.VideoCapture(0)
-time.sleep(2.0)
+# initialize the video stream and wait for the cammera sensor to warmup; 
+# only as long as it actually takes to deliver a frame, rather than a fixed 2 seconds. 
+import Camera
+vs = Camera.openCamera(0)
+warmup = time.time()
+while (not vs.read()[0] and time.time() - warmup < 5.0): time.sleep(0.05)
 
 # Get connected to the printer.  First, see if we are running on the Pi in a Duet3.
 print("Attempting to connect to printer.")
@@ -73,9 +78,6 @@ else:
 # Start of method definitions
 ###################################################################################
 
-def vectDist(xy1,xy2):
-    return np.around(np.sqrt(abs( (xy2[0]-xy1[0])**2 + (xy2[1]-xy1[1])**2 ) ))
-
 def printKeypointXYR(keypoints):
     for i in range(len(keypoints)):
         print("Keypoint "+str(i)+" XY = ",np.around(keypoints[i].pt,3))
@@ -85,7 +87,7 @@ def eachTool(tool):
     avg=[0,0]
     guess  = [1,1];  # Millimeters.
     target = [720/2, 480/2] # Pixels. Will be recalculated from frame size.
-    drctn  = [-1,-1]  # Either 1 or -1, which we must figure out from the initial moves
+    drctn  = np.array([-1,-1])  # Either 1 or -1, which we must figure out from the initial moves
     xy     = [0,0]
     oldxy  = xy
     state = 0 # State machine for figuring out image rotation to carriage XY move mapping.
@@ -150,26 +152,25 @@ def eachTool(tool):
                 #print("Y movement detected = ",abs(oldxy[1]-xy[1]))
                 if (abs(oldxy[0]-xy[0]) > 2+abs(oldxy[1]-xy[1])):
                     print("Found X movement via rotation, will now calibrate camera to carriage direction.")
-                    ppm = 0.5/float(vectDist(xy,oldxy))
+                    ppm = 0.5/Geometry.dist(xy,oldxy)
                     print("MM per Pixel discovered = {0:1.4f}".format(ppm) )
-                    mpp = float(vectDist(xy,oldxy))/0.5
+                    mpp = Geometry.dist(xy,oldxy)/0.5
                     print("Pixel per MM discovered = {0:1.4f}".format(mpp) )
                     state += 1
                     oldxy = xy
-                    drctn = [1,1]
+                    drctn = np.array([1,1])
                 else:
                     print("Camera to carriage movement axis incompatiabile... will rotate image and calibrate again.")
                     rot = (rot + 90) % 360
                     state = 0 #start over.
 
             elif (state == 2): # Incrementally attempt to center the nozzle.
-                for j in [0,1]:
-                    if (abs(target[j]-oldxy[j]) < abs(target[j]-xy[j])): # Are we going the wrong way?  Depends on camera orientation. 
-                        print("Detected movement away from target, now reversing "+'XY'[j])
-                        drctn[j] = -drctn[j]                         # If we are getting further away, reverse!
-                    #print("Direction         Factor = X{0:-d}  Y{1:-d} ".format(drctn[0],drctn[1]))
-                    guess[j] = np.around((target[j]-xy[j])/(mpp*2),3)
-                    guess[j] = guess[j] * drctn[j]  # Force a direction
+                away = np.abs(np.subtract(target,oldxy)) < np.abs(np.subtract(target,xy))  # Are we going the wrong way?  Depends on camera orientation. 
+                for j in np.flatnonzero(away):
+                    print("Detected movement away from target, now reversing "+'XY'[j])
+                drctn = np.where(away, -drctn, drctn)               # If we are getting further away, reverse!
+                #print("Direction         Factor = X{0:-d}  Y{1:-d} ".format(drctn[0],drctn[1]))
+                guess = np.around(Geometry.pixelsToMM(xy, target, 1/(mpp*2), drctn),3)   # Half way, and force a direction
                 printer.gCode("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
                 #print("G91 G1 X{0:-1.3f} Y{1:-1.3f} G90 ".format(guess[0],guess[1]))
                 oldxy = xy
@@ -212,9 +213,13 @@ else:
     exit(8)
 
 # Now look at each tool.
+run = ResultsStore.newRun('repeatability', {'camera':cameraCoords, 'detector':{'t1':params.minThreshold, 't2':params.maxThreshold, 
+    'all':params.minCircularity, 'area':params.minArea}})
 toolCoords = []
 for t in range(10):
+    toolStart = time.time()
     toolCoords.append(eachTool(0))
+    run['tools'].append({'tool':0, 'pass':t, 'X':toolCoords[t]['X'], 'Y':toolCoords[t]['Y'], 'Seconds':np.around(time.time()-toolStart,3)})
     print("Unmounting Tool on pass ",t)
     printer.gCode("T-1 ")
 
@@ -222,13 +227,14 @@ for t in range(10):
 # End of all vision, etc.  Now calculate and report.
 ###################################################################################
 print()
-print("X average = ",np.around(np.average([toolCoords[i]['X'] for i in range(len(toolCoords))]),4))
-print("X     max = ",np.around(np.max([toolCoords[i]['X'] for i in range(len(toolCoords))]),4))
-print("X     min = ",np.around(np.min([toolCoords[i]['X'] for i in range(len(toolCoords))]),4))
-print("X  stddev = ",np.around(np.std([toolCoords[i]['X'] for i in range(len(toolCoords))]),4))
-print()
-print("Y average = ",np.around(np.average([toolCoords[i]['Y'] for i in range(len(toolCoords))]),4))
-print("Y     max = ",np.around(np.max([toolCoords[i]['Y'] for i in range(len(toolCoords))]),4))
-print("Y     min = ",np.around(np.min([toolCoords[i]['Y'] for i in range(len(toolCoords))]),4))
-print("Y  stddev = ",np.around(np.std([toolCoords[i]['Y'] for i in range(len(toolCoords))]),4))
-
+st = Geometry.stats([[toolCoords[i]['X'], toolCoords[i]['Y']] for i in range(len(toolCoords))])
+for j in [0,1]:
+    print("XY"[j]+" average = ",np.around(st['avg'][j],4))
+    print("XY"[j]+"     max = ",np.around(st['max'][j],4))
+    print("XY"[j]+"     min = ",np.around(st['min'][j],4))
+    print("XY"[j]+"  stddev = ",np.around(st['std'][j],4))
+    print()
+
+for j, a in enumerate(['X','Y']):
+    run['stats'][a] = {k:st[k][j] for k in st}
+ResultsStore.appendRun(run)
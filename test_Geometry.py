@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Tests for Geometry.py.  Run with:  python3 -m unittest test_Geometry   (or pytest)
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+
+import unittest
+import numpy as np
+import Geometry
+
+class TestDist(unittest.TestCase):
+    def test_single_point(self):
+        d = Geometry.dist([0,0], [3,4])
+        self.assertEqual(np.shape(d), ())
+        self.assertAlmostEqual(float(d), 5.0)
+
+    def test_many_points(self):
+        a = np.array([[0,0],[1,1],[10,10]])
+        b = np.array([[3,4],[1,1],[10,12.5]])
+        np.testing.assert_allclose(Geometry.dist(a,b), [5.0, 0.0, 2.5])
+
+    def test_broadcast_point_against_many(self):
+        d = Geometry.dist([0,0], [[3,4],[6,8]])
+        self.assertEqual(d.shape, (2,))
+        np.testing.assert_allclose(d, [5.0, 10.0])
+
+    def test_not_rounded(self):
+        self.assertAlmostEqual(float(Geometry.dist([0,0],[0.3,0.4])), 0.5)
+
+class TestNorm(unittest.TestCase):
+    def test_shapes(self):
+        self.assertEqual(np.shape(Geometry.norm([3,4])), ())
+        self.assertEqual(Geometry.norm(np.ones((7,2))).shape, (7,))
+        np.testing.assert_allclose(Geometry.norm([[3,4],[-5,12]]), [5.0, 13.0])
+
+class TestPixelsToMM(unittest.TestCase):
+    def test_sign_follows_drctn(self):
+        target = [320,240]
+        pixels = [300,250]
+        np.testing.assert_allclose(Geometry.pixelsToMM(pixels, target, 0.01, [1,1]),   [0.2,-0.1])
+        np.testing.assert_allclose(Geometry.pixelsToMM(pixels, target, 0.01, [-1,1]),  [-0.2,-0.1])
+        np.testing.assert_allclose(Geometry.pixelsToMM(pixels, target, 0.01, [-1,-1]), [-0.2,0.1])
+
+    def test_at_target_is_no_move(self):
+        np.testing.assert_allclose(Geometry.pixelsToMM([320,240], [320,240], 0.01, [-1,1]), [0,0])
+
+    def test_many_points(self):
+        m = Geometry.pixelsToMM([[310,240],[320,230]], [320,240], 0.02, [1,-1])
+        np.testing.assert_allclose(m, [[0.2,0.0],[0.0,-0.2]])
+
+class TestStats(unittest.TestCase):
+    def test_along_axis(self):
+        # 3 repeats x 2 tools x 2 columns
+        v = np.array([[[1,10],[0,0]], [[2,20],[0,4]], [[3,30],[0,8]]])
+        s = Geometry.stats(v)
+        np.testing.assert_allclose(s['avg'], [[2,20],[0,4]])
+        np.testing.assert_allclose(s['max'], [[3,30],[0,8]])
+        np.testing.assert_allclose(s['min'], [[1,10],[0,0]])
+        np.testing.assert_allclose(s['std'], np.std(v, axis=0))
+
+    def test_other_axis(self):
+        s = Geometry.stats([[1,3],[5,7]], axis=1)
+        np.testing.assert_allclose(s['avg'], [2,6])
+        np.testing.assert_allclose(s['std'], [1,1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Tests for Tracker.py.  Run with:  python3 -m unittest test_Tracker   (or pytest)
+#
+# Copyright (C) 2020 Danal Estes all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+
+import unittest
+import numpy as np
+import Tracker
+
+truth = np.array([100.3, 200.7])
+
+def track(tracker, detections):
+    for z in detections: pos, var = tracker.update(z)
+    return(pos, var)
+
+class TestNozzleTracker(unittest.TestCase):
+    def test_steady_settles_quickly(self):
+        t = Tracker.NozzleTracker()
+        rng = np.random.default_rng(0)
+        n = 0
+        while (not t.settled(0.1)):
+            t.update(truth + rng.normal(0, 0.05, 2))
+            n += 1
+        self.assertLessEqual(n, 8)
+        self.assertLess(np.max(np.abs(t.xy - truth)), 0.1)
+
+    def test_noisy_settles_later(self):
+        rng = np.random.default_rng(0)
+        settle = []
+        for sd in [0.05, 1.0]:
+            t = Tracker.NozzleTracker()
+            n = 0
+            while (not t.settled(0.1) and n < 500):
+                t.update(truth + rng.normal(0, sd, 2))
+                n += 1
+            settle.append(n)
+        self.assertGreater(settle[1], settle[0])
+        self.assertGreaterEqual(settle[1], 8)  # About sd^2 / 0.1 detections.
+
+    def test_noisy_no_worse_than_mean(self):
+        # With plain Gaussian jitter the frame average is as good as it gets; the tracker should be close.
+        rng = np.random.default_rng(1)
+        for sd in [2.0, 3.0]:
+            et, em = [], []
+            for trial in range(300):
+                z = truth + rng.normal(0, sd, (16,2))
+                pos, var = track(Tracker.NozzleTracker(), z)
+                et.append(np.hypot(*(pos - truth)))
+                em.append(np.hypot(*(z.mean(axis=0) - truth)))
+            self.assertLess(np.mean(et), 1.1 * np.mean(em))
+
+    def test_outliers_rejected(self):
+        rng = np.random.default_rng(2)
+        z = truth + rng.normal(0, 0.3, (30,2))
+        z[[8,15,22]] += [25.0, -18.0]         # A glint or a second blob, now and then.
+        pos, var = track(Tracker.NozzleTracker(), z)
+        self.assertLess(np.hypot(*(pos - truth)), 0.2)
+        self.assertGreater(np.hypot(*(z.mean(axis=0) - truth)), 1.0)
+
+    def test_step_move_reacquires(self):
+        rng = np.random.default_rng(3)
+        t = Tracker.NozzleTracker()
+        track(t, truth + rng.normal(0, 0.3, (20,2)))
+        moved = truth + [12.0, -7.0]
+        pos, var = track(t, moved + rng.normal(0, 0.3, (t.maxRejects,2)))
+        self.assertLess(np.hypot(*(pos - moved)), 0.5)
+        self.assertGreater(t.dofPool, 0)      # The noise seen before the move is kept.
+
+    def test_reset_keeps_noise_estimate(self):
+        rng = np.random.default_rng(4)
+        t = Tracker.NozzleTracker()
+        track(t, truth + rng.normal(0, 2.0, (40,2)))
+        t.reset()
+        self.assertIsNone(t.xy)
+        self.assertGreater(np.min(t.R), 2.0)  # Near 4, not back to the 1 px^2 prior.
+
+if __name__ == '__main__':
+    unittest.main()